@@ -0,0 +1,300 @@
+"""DarkJarvis çevrimdışı yük testi.
+
+Gerçek Telegram ve ücretli AI servisleri yerine yerel sahte sunucularla, main()'deki ile aynı Application'ı
+(build_application) sentetik güncellemelerle sürer: çok sayıda kullanıcı, grup, buton ve duyuru.
+
+    python bench.py --users 200 --groups 5 --messages 5 --llm-latency 0.8 --llm-429 0.05
+
+Rapor: mesaj/sn, cevap gecikmesi yüzdelikleri, users / user_words / sohbet hafızası bellek büyümesi ve kayıt maliyeti.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import defaultdict, deque
+from urllib.parse import parse_qs, urlsplit
+
+SIGNATURE = "🤖 DarkJarvis"  # imzali() ile biten mesajlar tamamlanmış cevaptır
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "DarkJarvis", "username": "darkjarvis_bench_bot", "can_join_groups": True, "can_read_all_group_messages": True, "supports_inline_queries": False}
+STATUS_TEXT = {200: "OK", 400: "Bad Request", 404: "Not Found", 429: "Too Many Requests"}
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description="DarkJarvis çevrimdışı yük testi")
+    p.add_argument("--users", type=int, default=100, help="sentetik kullanıcı sayısı")
+    p.add_argument("--groups", type=int, default=3, help="sentetik grup sayısı")
+    p.add_argument("--messages", type=int, default=3, help="kullanıcı başına metin mesajı")
+    p.add_argument("--group-share", type=float, default=0.3, help="mesajların gruplara giden oranı")
+    p.add_argument("--callbacks", type=int, default=2, help="kullanıcı başına buton tıklaması")
+    p.add_argument("--rate", type=float, default=0, help="saniyedeki güncelleme (0 = bekleme yok)")
+    p.add_argument("--broadcast", action="store_true", help="sonunda tüm kullanıcılara duyuru gönder")
+    p.add_argument("--broadcast-rate", type=float, default=None, help="BROADCAST_RATE (varsayılan: bot ayarı)")
+    p.add_argument("--llm-latency", type=float, default=0.5, help="sahte AI cevap süresi (sn)")
+    p.add_argument("--llm-jitter", type=float, default=0.2, help="cevap süresine eklenen rastgele sapma (sn)")
+    p.add_argument("--llm-429", type=float, default=0.0, help="429 dönme olasılığı")
+    p.add_argument("--llm-chunks", type=int, default=8, help="akışlı cevaptaki parça sayısı")
+    p.add_argument("--tg-latency", type=float, default=0.02, help="sahte Bot API gecikmesi (sn)")
+    p.add_argument("--tg-429", type=float, default=0.0, help="Bot API'nin flood (429) dönme olasılığı")
+    p.add_argument("--no-stream", action="store_true", help="AI_STREAMING=0 ile çalıştır")
+    p.add_argument("--timeout", type=float, default=300, help="aşama başına en uzun bekleme (sn)")
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--json", help="sonuçları bu dosyaya JSON olarak da yaz")
+    return p.parse_args()
+
+
+# --- YEREL HTTP SUNUCUSU ---
+class MiniHTTPServer:
+    """Keep-alive ve chunked (akışlı) cevap destekli küçük HTTP/1.1 sunucusu; handler(method, path, headers, body) -> (status, headers, gövde)."""
+    def __init__(self, handler): self.handler = handler; self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._client, "127.0.0.1", 0)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        self.server.close(); await self.server.wait_closed()
+
+    async def _client(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line: break
+                method, path, _ = line.decode("latin-1").split(" ", 2); headers = {}
+                while True:
+                    h = await reader.readline()
+                    if h in (b"\r\n", b"\n", b""): break
+                    k, v = h.decode("latin-1").split(":", 1); headers[k.strip().lower()] = v.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                status, extra, payload = await self.handler(method, path, headers, body)
+                head = f"HTTP/1.1 {status} {STATUS_TEXT.get(status, 'OK')}\r\n" + "".join(f"{k}: {v}\r\n" for k, v in extra.items())
+                if isinstance(payload, (bytes, str)):
+                    data = payload.encode("utf-8") if isinstance(payload, str) else payload
+                    writer.write(f"{head}Content-Length: {len(data)}\r\n\r\n".encode() + data)
+                else:
+                    writer.write(f"{head}Transfer-Encoding: chunked\r\n\r\n".encode())
+                    async for chunk in payload:
+                        data = chunk.encode("utf-8"); writer.write(f"{len(data):X}\r\n".encode() + data + b"\r\n"); await writer.drain()
+                    writer.write(b"0\r\n\r\n")
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close": break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError): pass
+        except asyncio.CancelledError: pass  # kapanışta yarım kalan istek (örn. arka plan doldurması)
+        finally: writer.close()
+
+
+# --- SAHTE AI SUNUCUSU ---
+class FakeLLM:
+    """OpenAI uyumlu /chat/completions: ayarlanabilir gecikme, SSE akışı ve rastgele 429."""
+    def __init__(self, args, rng):
+        self.args = args; self.rng = rng; self.requests = 0; self.throttled = 0; self.streamed = 0; self.inflight = 0; self.peak_inflight = 0
+
+    async def handle(self, method, path, headers, body):
+        self.requests += 1
+        if self.rng.random() < self.args.llm_429:
+            self.throttled += 1
+            return 429, {"Retry-After": "0.2", "Content-Type": "application/json"}, json.dumps({"error": {"message": "rate limited"}})
+        req = json.loads(body or b"{}"); words = f"bench cevabı {self.requests} " * max(1, self.args.llm_chunks)
+        delay = self.args.llm_latency + self.rng.uniform(0, self.args.llm_jitter)
+        if req.get("stream"):
+            self.streamed += 1
+            return 200, {"Content-Type": "text/event-stream"}, self._stream(words.split(" "), delay)
+        self.inflight += 1; self.peak_inflight = max(self.peak_inflight, self.inflight)
+        try: await asyncio.sleep(delay)
+        finally: self.inflight -= 1
+        return 200, {"Content-Type": "application/json"}, json.dumps({"choices": [{"message": {"role": "assistant", "content": words.strip()}}]})
+
+    async def _stream(self, parts, delay):
+        self.inflight += 1; self.peak_inflight = max(self.peak_inflight, self.inflight)
+        try:
+            n = max(1, len(parts)); await asyncio.sleep(delay / 2)  # ilk token gecikmesi
+            yield ": OPENROUTER PROCESSING\n\n"
+            for part in parts:
+                await asyncio.sleep(delay / 2 / n)
+                yield "data: " + json.dumps({"choices": [{"delta": {"content": part + " "}}]}, ensure_ascii=False) + "\n\n"
+            yield "data: [DONE]\n\n"
+        finally: self.inflight -= 1
+
+
+# --- SAHTE TELEGRAM BOT API ---
+class FakeTelegram:
+    """Bot API'nin kullanılan metotlarını taklit eder; imzalı (tamamlanmış) cevaplar geldiğinde on_final(chat_id) çağrılır."""
+    def __init__(self, args, rng, on_final):
+        self.args = args; self.rng = rng; self.on_final = on_final
+        self.calls = defaultdict(int); self.flooded = 0; self.message_ids = defaultdict(int)
+
+    def _message(self, chat_id, text):
+        self.message_ids[chat_id] += 1
+        chat = {"id": chat_id, "type": "private", "first_name": f"u{chat_id}"} if chat_id > 0 else {"id": chat_id, "type": "supergroup", "title": f"Grup {chat_id}"}
+        return {"message_id": self.message_ids[chat_id], "date": int(time.time()), "chat": chat, "from": BOT_USER, "text": text}
+
+    async def handle(self, method, path, headers, body):
+        api_method = path.rsplit("/", 1)[-1]; self.calls[api_method] += 1
+        params = {}
+        for key, values in parse_qs(body.decode("utf-8"), keep_blank_values=True).items():
+            try: params[key] = json.loads(values[0])
+            except ValueError: params[key] = values[0]
+        if self.args.tg_latency: await asyncio.sleep(self.args.tg_latency)
+        if api_method in ("sendMessage", "editMessageText") and self.rng.random() < self.args.tg_429:
+            self.flooded += 1
+            return 429, {"Content-Type": "application/json"}, json.dumps({"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1", "parameters": {"retry_after": 1}})
+        if api_method == "getMe": result = BOT_USER
+        elif api_method in ("sendMessage", "editMessageText"):
+            chat_id = int(params.get("chat_id", 0)); text = str(params.get("text", "")); result = self._message(chat_id, text)
+            if SIGNATURE in text: self.on_final(chat_id)
+        else: result = True
+        return 200, {"Content-Type": "application/json"}, json.dumps({"ok": True, "result": result}, ensure_ascii=False)
+
+
+# --- ÖLÇÜM YARDIMCILARI ---
+def percentiles(values):
+    if not values: return {"p50": 0, "p95": 0, "p99": 0, "max": 0}
+    data = sorted(values); pick = lambda q: data[min(len(data) - 1, int(q * len(data)))]
+    return {"p50": pick(0.5), "p95": pick(0.95), "p99": pick(0.99), "max": data[-1]}
+
+def deep_size(obj, seen=None):
+    """Nesnenin (içindekilerle birlikte) yaklaşık bellek boyutu."""
+    seen = set() if seen is None else seen
+    if id(obj) in seen: return 0
+    seen.add(id(obj)); size = sys.getsizeof(obj)
+    if isinstance(obj, dict): size += sum(deep_size(k, seen) + deep_size(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset, deque)): size += sum(deep_size(i, seen) for i in obj)
+    elif hasattr(obj, "__dict__"): size += deep_size(vars(obj), seen)
+    elif hasattr(obj, "__slots__"): size += sum(deep_size(getattr(obj, a), seen) for a in obj.__slots__ if hasattr(obj, a))
+    return size
+
+def memory_snapshot(bot):
+    return {"traced_kb": tracemalloc.get_traced_memory()[0] // 1024, "users_kb": deep_size(bot.users) // 1024, "user_words_kb": deep_size(bot.user_words) // 1024,
+            "conversations_kb": deep_size(bot.conversation_memory.hot) // 1024, "word_scopes_kb": deep_size(bot.word_scopes) // 1024}
+
+
+class Tracker:
+    """Sohbet başına cevap bekleyen güncellemelerin gönderim zamanları; imzalı cevap gelince hepsi kapanır (birleştirilen mesajlar dahil)."""
+    def __init__(self): self.pending = defaultdict(deque); self.latencies = []; self.done = asyncio.Event(); self.open = 0
+
+    def submit(self, chat_id): self.pending[chat_id].append(time.perf_counter()); self.open += 1; self.done.clear()
+
+    def final(self, chat_id):
+        now = time.perf_counter(); q = self.pending.get(chat_id)
+        while q: self.latencies.append(now - q.popleft()); self.open -= 1
+        if self.open == 0: self.done.set()
+
+
+def user_dict(uid): return {"id": uid, "is_bot": False, "first_name": f"u{uid}", "language_code": "tr"}
+def text_update(update_id, uid, chat_id, text):
+    chat = {"id": chat_id, "type": "private", "first_name": f"u{uid}"} if chat_id > 0 else {"id": chat_id, "type": "supergroup", "title": f"Grup {chat_id}"}
+    return {"update_id": update_id, "message": {"message_id": update_id, "date": int(time.time()), "chat": chat, "from": user_dict(uid), "text": text}}
+def callback_update(update_id, uid, data):
+    message = {"message_id": 1, "date": int(time.time()), "chat": {"id": uid, "type": "private", "first_name": f"u{uid}"}, "from": BOT_USER, "text": "menü"}
+    return {"update_id": update_id, "callback_query": {"id": str(update_id), "from": user_dict(uid), "chat_instance": str(uid), "data": data, "message": message}}
+
+WORDS = "merhaba nasılsın bugün hava çok güzel İstanbul trafiği berbat kahve içelim akşam maç var IŞIK ırmak şarkı dinliyorum".split()
+
+
+async def run_phase(app, tracker, updates, rate, timeout):
+    """Güncellemeleri update_queue'ya verir, tüm cevaplar gelene kadar bekler; (süre, zaman aşımına uğrayan) döner."""
+    from telegram import Update
+    t0 = time.perf_counter()
+    for chat_id, data in updates:
+        tracker.submit(chat_id); await app.update_queue.put(Update.de_json(data, app.bot))
+        if rate: await asyncio.sleep(1 / rate)
+    if tracker.open:
+        try: await asyncio.wait_for(tracker.done.wait(), timeout)
+        except asyncio.TimeoutError: pass
+    return time.perf_counter() - t0, tracker.open
+
+
+async def bench(args):
+    rng = random.Random(args.seed); tracemalloc.start()
+    import bot  # ortam değişkenleri main() içinde ayarlandıktan sonra
+    logging.getLogger().setLevel(logging.WARNING); logging.getLogger("httpx").setLevel(logging.WARNING)
+    bot.load_data()
+
+    text_tracker, cb_tracker = Tracker(), Tracker(); active = {"tracker": text_tracker}
+    llm = FakeLLM(args, rng); tg = FakeTelegram(args, rng, lambda chat_id: active["tracker"].final(chat_id))
+    llm_server, tg_server = MiniHTTPServer(llm.handle), MiniHTTPServer(tg.handle)
+    llm_port, tg_port = await llm_server.start(), await tg_server.start()
+    for cfg in bot.AI_PROVIDERS.values(): cfg["url"] = f"http://127.0.0.1:{llm_port}/v1/chat/completions"; cfg["key"] = "bench"
+
+    app = bot.build_application(token="123456:BENCH", base_url=f"http://127.0.0.1:{tg_port}/bot")
+    await app.initialize(); await app.post_init(app); await app.start()
+    mem_start = memory_snapshot(bot); update_id = 0; results = {"args": vars(args)}
+
+    # 1) Metin mesajları: özel sohbetler + gruplar
+    users = list(range(1000, 1000 + args.users)); groups = [-(100000 + i) for i in range(args.groups)]; updates = []
+    for _ in range(args.messages):
+        for uid in rng.sample(users, len(users)):
+            update_id += 1; chat_id = rng.choice(groups) if groups and rng.random() < args.group_share else uid
+            updates.append((chat_id, text_update(update_id, uid, chat_id, " ".join(rng.choices(WORDS, k=rng.randint(3, 12))))))
+    elapsed, lost = await run_phase(app, text_tracker, updates, args.rate, args.timeout)
+    results["text"] = {"updates": len(updates), "seconds": round(elapsed, 3), "msgs_per_sec": round(len(updates) / elapsed, 1) if elapsed else 0, "unanswered": lost,
+                       "latency_ms": {k: round(v * 1000) for k, v in percentiles(text_tracker.latencies).items()}}
+    mem_text = memory_snapshot(bot)
+
+    # 2) Butonlar: fal / şaka (hazır cevap havuzu), analiz ve liderlik tablosu
+    active["tracker"] = cb_tracker; updates = []
+    for uid in users:
+        for data in rng.choices(["menu_fal", "ai_saka", "menu_analiz", "analiz_top_w", "menu_eglence"], k=args.callbacks):
+            update_id += 1; updates.append((uid, callback_update(update_id, uid, data)))
+    elapsed, lost = await run_phase(app, cb_tracker, updates, args.rate, args.timeout)
+    results["callbacks"] = {"updates": len(updates), "seconds": round(elapsed, 3), "per_sec": round(len(updates) / elapsed, 1) if elapsed else 0, "unanswered": lost,
+                            "latency_ms": {k: round(v * 1000) for k, v in percentiles(cb_tracker.latencies).items()}}
+
+    # 3) Duyuru
+    if args.broadcast:
+        sent_before = tg.calls["sendMessage"]; t0 = time.perf_counter()
+        await bot.start_broadcast(app, "users", "📣 bench duyurusu")
+        await asyncio.sleep(0)
+        while bot.broadcast_engine.running: await asyncio.sleep(0.05)
+        elapsed = time.perf_counter() - t0; sent = tg.calls["sendMessage"] - sent_before
+        results["broadcast"] = {"messages": sent, "seconds": round(elapsed, 3), "msgs_per_sec": round(sent / elapsed, 1) if elapsed else 0}
+
+    # 4) Kayıt maliyeti
+    t0 = time.perf_counter(); await bot.flush_data(); final_flush = time.perf_counter() - t0
+    hist = lambda name: bot.metrics.histograms.get((name, ()))
+    write, blocked = hist("store_write_seconds"), hist("store_loop_blocked_seconds")
+    results["persistence"] = {"flushes": bot.store.flushes, "rows_written": bot.store.rows_written, "bytes_written": bot.metrics.counters.get(("store_bytes_written_total", ()), 0),
+                              "write_ms_total": round(write.sum * 1000, 1) if write else 0, "loop_blocked_ms_total": round(blocked.sum * 1000, 1) if blocked else 0,
+                              "final_flush_ms": round(final_flush * 1000, 1), "db_kb": os.path.getsize(bot.DB_FILE) // 1024}
+    results["memory_kb"] = {"start": mem_start, "after_text": mem_text, "end": memory_snapshot(bot)}
+    results["ai"] = {"requests": llm.requests, "throttled_429": llm.throttled, "streamed": llm.streamed, "peak_concurrency": llm.peak_inflight, "scheduler": bot.ai_scheduler.stats(), "prompt_pool": bot.prompt_pool.stats()}
+    results["telegram"] = {"calls": dict(tg.calls), "flooded_429": tg.flooded}
+    results["handlers_ms"] = bot.metrics.summary({"handler_seconds"}); results["ai_ms"] = bot.metrics.summary({"ai_queue_wait_seconds", "ai_request_seconds", "ai_first_token_seconds"})
+
+    await app.stop(); await bot.on_shutdown(app); await app.shutdown()
+    await llm_server.close(); await tg_server.close(); bot.store.close()
+    return results
+
+
+def report(r):
+    t, c = r["text"], r["callbacks"]
+    print(f"\n=== Metin mesajları ===\n{t['updates']} güncelleme, {t['seconds']} sn → {t['msgs_per_sec']} mesaj/sn, cevapsız: {t['unanswered']}")
+    print("Cevap gecikmesi (ms): " + ", ".join(f"{k} {v}" for k, v in t["latency_ms"].items()))
+    print(f"\n=== Butonlar ===\n{c['updates']} tıklama, {c['seconds']} sn → {c['per_sec']}/sn, cevapsız: {c['unanswered']}")
+    print("Cevap gecikmesi (ms): " + ", ".join(f"{k} {v}" for k, v in c["latency_ms"].items()))
+    if "broadcast" in r: b = r["broadcast"]; print(f"\n=== Duyuru ===\n{b['messages']} mesaj, {b['seconds']} sn → {b['msgs_per_sec']} mesaj/sn")
+    print(f"\n=== Handler süreleri ===\n{r['handlers_ms']}\n\n=== AI ===\n{r['ai_ms']}")
+    a = r["ai"]; print(f"İstek {a['requests']}, 429 {a['throttled_429']}, akış {a['streamed']}, sunucuda eşzamanlı zirve {a['peak_concurrency']}, kuyruk zirvesi {a['scheduler']['peak_queue']}, havuz isabet {a['prompt_pool']['hits']}/{a['prompt_pool']['hits'] + a['prompt_pool']['misses']}")
+    print("\n=== Bellek (KB) ===")
+    for stage, snap in r["memory_kb"].items(): print(f"{stage:>10}: " + ", ".join(f"{k} {v}" for k, v in snap.items()))
+    p = r["persistence"]; print(f"\n=== Kayıt ===\n{p['flushes']} toplu kayıt, {p['rows_written']} satır, {p['bytes_written']} bayt; yazma {p['write_ms_total']} ms, döngü blok {p['loop_blocked_ms_total']} ms, son kayıt {p['final_flush_ms']} ms, veritabanı {p['db_kb']} KB")
+    print(f"\nTelegram çağrıları: {r['telegram']['calls']}, flood: {r['telegram']['flooded_429']}")
+
+
+def main():
+    args = parse_args(); tmp = tempfile.mkdtemp(prefix="darkjarvis_bench_")
+    # Bot modülü ayarlarını içe aktarılırken okur. Veritabanı, eski JSON dosyaları ve log geçici dizindedir:
+    # repodaki gerçek kullanıcılar içeri aktarılmaz, bot.log'a yazılmaz, gerçek servislere dokunulmaz
+    os.environ.update({"DB_FILE": os.path.join(tmp, "bench.db"), "USERS_FILE": os.path.join(tmp, "users_data.json"), "GROUPS_FILE": os.path.join(tmp, "groups.json"), "LOG_FILE": os.path.join(tmp, "bot.log"), "TELEGRAM_TOKEN": "123456:BENCH", "ADMIN_USER_ID": "1", "AI_STREAMING": "0" if args.no_stream else "1", "METRICS_PORT": "0", "PROMPT_POOL_REFILL_INTERVAL": "3600"})
+    if args.broadcast_rate: os.environ["BROADCAST_RATE"] = str(args.broadcast_rate)
+    results = asyncio.run(bench(args)); report(results)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f: json.dump(results, f, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    main()
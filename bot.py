@@ -2,21 +2,39 @@ import os
 import sys
 import logging
 import json
+import sqlite3
+import threading
+import bisect
+import functools
+import traceback
+from time import perf_counter
 import httpx
 from dotenv import load_dotenv
 import asyncio
 import random
-from datetime import time
+import contextlib
+import hashlib
+import heapq
+import itertools
+import re
+import struct
+import hmac
+import secrets
+import queue
+import signal
+import multiprocessing
+from datetime import time, datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
 import pytz
-from collections import Counter, deque
+from collections import Counter, OrderedDict, deque
 
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
     Application, CommandHandler, MessageHandler, filters,
-    CallbackQueryHandler, ContextTypes, ConversationHandler
+    CallbackQueryHandler, ContextTypes, ConversationHandler, BaseUpdateProcessor
 )
 from telegram.constants import ParseMode, ChatType
-from telegram.error import TelegramError
+from telegram.error import TelegramError, RetryAfter, BadRequest, Forbidden, NetworkError
 
 # --- YAPI ---
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -31,98 +49,1096 @@ WEATHER_API_KEY = os.getenv("WEATHER_API_KEY")
 DEFAULT_AI_MODEL = os.getenv("DEFAULT_AI_MODEL", "openrouter")
 current_model = DEFAULT_AI_MODEL
 
-USERS_FILE = os.path.join(BASE_DIR, "users_data.json")
-GROUPS_FILE = os.path.join(BASE_DIR, "groups.json")
-LOG_FILE = os.path.join(BASE_DIR, "bot.log")
+# AI HTTP bağlantı havuzu ayarları (sağlayıcı başına)
+AI_HTTP2 = os.getenv("AI_HTTP2", "1") == "1"
+AI_MAX_CONNECTIONS = int(os.getenv("AI_MAX_CONNECTIONS", 20))
+AI_MAX_KEEPALIVE = int(os.getenv("AI_MAX_KEEPALIVE", 10))
+AI_KEEPALIVE_EXPIRY = float(os.getenv("AI_KEEPALIVE_EXPIRY", 60))
+AI_CONNECT_TIMEOUT = float(os.getenv("AI_CONNECT_TIMEOUT", 5))
+AI_READ_TIMEOUT = float(os.getenv("AI_READ_TIMEOUT", 40))
+AI_WRITE_TIMEOUT = float(os.getenv("AI_WRITE_TIMEOUT", 10))
+AI_POOL_TIMEOUT = float(os.getenv("AI_POOL_TIMEOUT", 10))
+
+# AI zamanlayıcı ayarları: eşzamanlı istek sınırları, kuyruk kapasitesi ve tekrar deneme
+AI_MAX_INFLIGHT = int(os.getenv("AI_MAX_INFLIGHT", 8))
+AI_PROVIDER_MAX_INFLIGHT = int(os.getenv("AI_PROVIDER_MAX_INFLIGHT", 6))
+AI_MAX_QUEUE = int(os.getenv("AI_MAX_QUEUE", 200))
+AI_MAX_RETRIES = int(os.getenv("AI_MAX_RETRIES", 3))
+AI_RETRY_BASE_DELAY = float(os.getenv("AI_RETRY_BASE_DELAY", 1.0))
+AI_RETRY_MAX_DELAY = float(os.getenv("AI_RETRY_MAX_DELAY", 30))
+
+# Hazır cevap havuzu: sabit istemli özellikler (fal, şaka, günaydın, günün atarı) için önceden üretilmiş cevaplar.
+# Havuz talebe göre büyür: PROMPT_POOL_SIZE şablon başına üst sınırdır; gösterilen taze cevabın yerine hemen yenisi üretilir.
+# PROMPT_POOL_REFILL_INTERVAL: yoğunluk yüzünden ertelenen doldurmaların yeniden denenme aralığı.
+PROMPT_POOL_SIZE = int(os.getenv("PROMPT_POOL_SIZE", 8))
+PROMPT_POOL_TTL = float(os.getenv("PROMPT_POOL_TTL", 6 * 3600))
+PROMPT_POOL_MAX_TEMPLATES = int(os.getenv("PROMPT_POOL_MAX_TEMPLATES", 32))
+PROMPT_POOL_SEEN_PER_USER = int(os.getenv("PROMPT_POOL_SEEN_PER_USER", 64))
+PROMPT_POOL_MAX_USERS = int(os.getenv("PROMPT_POOL_MAX_USERS", 10000))
+PROMPT_POOL_REFILL_INTERVAL = float(os.getenv("PROMPT_POOL_REFILL_INTERVAL", 30))
+
+# Akışlı (stream) cevap ayarları: mesaj düzenleme aralıkları saniye cinsinden
+AI_STREAMING = os.getenv("AI_STREAMING", "1") == "1"
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", 1.0))
+STREAM_GROUP_EDIT_INTERVAL = float(os.getenv("STREAM_GROUP_EDIT_INTERVAL", 3.0))
+TELEGRAM_MAX_TEXT = 4096
+
+USERS_FILE = os.getenv("USERS_FILE", os.path.join(BASE_DIR, "users_data.json"))
+GROUPS_FILE = os.getenv("GROUPS_FILE", os.path.join(BASE_DIR, "groups.json"))
+DB_FILE = os.getenv("DB_FILE", os.path.join(BASE_DIR, "bot_data.db"))
+STORE_FLUSH_INTERVAL = float(os.getenv("STORE_FLUSH_INTERVAL", 5))
+TURKEY_TZ = pytz.timezone("Europe/Istanbul")
+
+# Duyuru motoru: Telegram global sınırı ~30 mesaj/sn; aynı sohbete özelde ~1/sn, grupta ~20/dk
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", 28))
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", 32))
+BROADCAST_PRIVATE_INTERVAL = float(os.getenv("BROADCAST_PRIVATE_INTERVAL", 1.0))
+BROADCAST_GROUP_INTERVAL = float(os.getenv("BROADCAST_GROUP_INTERVAL", 3.0))
+BROADCAST_STATUS_INTERVAL = float(os.getenv("BROADCAST_STATUS_INTERVAL", 3.0))
+
+# Kelime istatistikleri: kullanıcı / sohbet başına izlenen en fazla kelime sayısı ve günlük kovaların saklanma süresi
+WORD_SKETCH_USER_CAPACITY = int(os.getenv("WORD_SKETCH_USER_CAPACITY", 32))
+WORD_SKETCH_SCOPE_CAPACITY = int(os.getenv("WORD_SKETCH_SCOPE_CAPACITY", 128))
+WORD_DAYS_KEPT = int(os.getenv("WORD_DAYS_KEPT", 7))
+
+# Sohbet hafızası: son mesajlar için yaklaşık token bütçesi, özetleme eşiği ve bellekte tutulan aktif kullanıcı sayısı
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", 1200))
+HISTORY_SUMMARY_TOKENS = int(os.getenv("HISTORY_SUMMARY_TOKENS", 250))
+HISTORY_SUMMARIZE_AFTER = int(os.getenv("HISTORY_SUMMARIZE_AFTER", 400))
+HISTORY_HOT_USERS = int(os.getenv("HISTORY_HOT_USERS", 2000))
+HISTORY_IDLE_SECONDS = float(os.getenv("HISTORY_IDLE_SECONDS", 1800))
+LOG_FILE = os.getenv("LOG_FILE", os.path.join(BASE_DIR, "bot.log"))
+
+# Metrikler: METRICS_PORT verilirse Prometheus metin formatında /metrics sunulur (0 = kapalı)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", 0))
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", 0.5))
+PROFILER_ON_START = os.getenv("PROFILER", "0") == "1"
+PROFILER_INTERVAL = float(os.getenv("PROFILER_INTERVAL", 0.01))
+PROFILE_DIR = os.getenv("PROFILE_DIR", BASE_DIR)
+
+# Güncelleme işleme: aynı (sohbet, kullanıcı) sırayla, farklı sohbetler eşzamanlı işlenir
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", 64))
+UPDATE_MAX_PENDING = int(os.getenv("UPDATE_MAX_PENDING", 10000))
+# Webhook modu: WEBHOOK_URL verilirse polling yerine yerel HTTP dinleyicisi kullanılır (örn. https://bot.example.com)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", os.getenv("PORT", 8443)))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram").strip("/")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")  # boşsa açılışta rastgele üretilir; webhook gizli anahtarsız çalışmaz
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", 40))
+# WORKERS > 1: sohbetler kullanıcı/sohbet kimliğine göre işçi süreçlere dağıtılır (sadece webhook modunda)
+WORKERS = int(os.getenv("WORKERS", 1))
+WORKER_ID = None  # işçi süreçte 0..WORKERS-1, tek süreçte None
 
 # --- LOG ---
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", handlers=[logging.FileHandler(LOG_FILE, encoding='utf-8'), logging.StreamHandler(sys.stdout)])
 logger = logging.getLogger("DarkJarvis")
 
+# --- METRİKLER ---
+METRIC_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+class Histogram:
+    """Prometheus kovaları + yüzdelikler (p50/p95/p99) için son örneklerden oluşan sabit boyutlu havuz."""
+    __slots__ = ("counts", "sum", "count", "recent")
+    def __init__(self): self.counts = [0] * (len(METRIC_BUCKETS) + 1); self.sum = 0.0; self.count = 0; self.recent = deque(maxlen=2048)
+    def observe(self, value):
+        self.counts[bisect.bisect_left(METRIC_BUCKETS, value)] += 1; self.sum += value; self.count += 1; self.recent.append(value)
+    def percentile(self, q):
+        if not self.recent: return 0.0
+        data = sorted(self.recent); return data[min(len(data) - 1, int(q * len(data)))]
+
+class Metrics:
+    def __init__(self, prefix):
+        self.prefix = prefix; self.lock = threading.Lock()  # depo yazımları iş parçacığından da ölçülür
+        self.histograms = {}; self.counters = {}; self.gauges = {}
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            hist = self.histograms.get(key)
+            if hist is None: hist = self.histograms[key] = Histogram()
+            hist.observe(value)
+
+    def inc(self, name, n=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock: self.counters[key] = self.counters.get(key, 0) + n
+
+    def gauge(self, name, fn, **labels): self.gauges[(name, tuple(sorted(labels.items())))] = fn
+
+    def _labels(self, labels, extra=()):
+        items = list(labels) + list(extra)
+        return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}" if items else ""
+
+    def render(self):
+        """Prometheus metin formatı."""
+        out = []; p = self.prefix
+        with self.lock: hists = list(self.histograms.items()); counters = list(self.counters.items())
+        typed = set()
+        def type_line(name, kind):
+            if name not in typed: typed.add(name); out.append(f"# TYPE {p}_{name} {kind}")
+        for (name, labels), hist in sorted(hists, key=lambda kv: kv[0]):
+            type_line(name, "histogram"); cum = 0
+            for bound, n in zip(METRIC_BUCKETS + ("+Inf",), hist.counts):
+                cum += n; out.append(f"{p}_{name}_bucket{self._labels(labels, [('le', bound)])} {cum}")
+            out.append(f"{p}_{name}_sum{self._labels(labels)} {hist.sum:.6f}"); out.append(f"{p}_{name}_count{self._labels(labels)} {hist.count}")
+        for (name, labels), value in sorted(counters): type_line(name, "counter"); out.append(f"{p}_{name}{self._labels(labels)} {value}")
+        for (name, labels), fn in sorted(self.gauges.items(), key=lambda kv: kv[0]):
+            try: value = fn()
+            except Exception: continue
+            type_line(name, "gauge"); out.append(f"{p}_{name}{self._labels(labels)} {value}")
+        return "\n".join(out) + "\n"
+
+    def summary(self, names):
+        """Admin paneli için p50/p95/p99 özeti (ms)."""
+        lines = []
+        with self.lock: hists = sorted(((k, h) for k, h in self.histograms.items() if k[0] in names), key=lambda kv: kv[0])
+        for (name, labels), h in hists:
+            label = f"{name.removesuffix('_seconds')} " + ",".join(str(v) for _, v in labels)
+            lines.append(f"- {label}: p50 {h.percentile(0.5) * 1000:.0f} / p95 {h.percentile(0.95) * 1000:.0f} / p99 {h.percentile(0.99) * 1000:.0f} ms (n={h.count})")
+        return "\n".join(lines) or "- Henüz veri yok."
+
+metrics = Metrics("darkjarvis")
+
+def timed(name, handler):
+    """Handler'ın süresini handler_seconds{handler=name} histogramına yazar."""
+    @functools.wraps(handler)
+    async def wrapper(update, context, *args, **kwargs):
+        t0 = perf_counter()
+        try: return await handler(update, context, *args, **kwargs)
+        finally: metrics.observe("handler_seconds", perf_counter() - t0, handler=name)
+    return wrapper
+
+async def monitor_loop_lag():
+    """Olay döngüsü gecikmesi: uyku süresinin ne kadar geç bittiğini ölçer."""
+    loop = asyncio.get_running_loop()
+    while True:
+        t0 = loop.time(); await asyncio.sleep(LOOP_LAG_INTERVAL)
+        metrics.observe("event_loop_lag_seconds", max(0.0, loop.time() - t0 - LOOP_LAG_INTERVAL))
+
+# --- MİNİ HTTP SUNUCU (metrikler ve webhook) ---
+HTTP_MAX_BODY = 1 << 20
+async def _read_http_request(reader):
+    """(method, path, headers, body) döner; bağlantı kapandıysa None."""
+    request_line = await reader.readline()
+    if not request_line: return None
+    method, path = request_line.decode("latin-1").split()[:2]; headers = {}
+    while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+        name, _, value = line.decode("latin-1").partition(":"); headers[name.strip().lower()] = value.strip()
+    length = int(headers.get("content-length") or 0)
+    if length > HTTP_MAX_BODY: raise ValueError("istek gövdesi çok büyük")
+    return method, path, headers, await reader.readexactly(length)
+
+def http_server(handler, idle_timeout=30):
+    """asyncio.start_server için keep-alive destekli istemci fonksiyonu; handler(method, path, headers, body) -> (durum, gövde, içerik türü)."""
+    async def client(reader, writer):
+        try:
+            while (request := await asyncio.wait_for(_read_http_request(reader), idle_timeout)) is not None:
+                try: status, body, content_type = await handler(*request)
+                except Exception as e: logger.error(f"HTTP isteği işlenemedi: {e}", exc_info=True); status, body, content_type = "500 Internal Server Error", b"", "text/plain; charset=utf-8"
+                keep_alive = request[2].get("connection", "").lower() != "close"
+                writer.write(f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\nConnection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode() + body)
+                await writer.drain()
+                if not keep_alive: break
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError): pass
+        finally: writer.close()
+    return client
+
+async def _metrics_handler(method, path, headers, body):
+    if path.startswith("/metrics"): return "200 OK", metrics.render().encode("utf-8"), "text/plain; version=0.0.4; charset=utf-8"
+    return "404 Not Found", b"not found\n", "text/plain; charset=utf-8"
+
+class SamplingProfiler:
+    """Ana iş parçacığının yığınını periyodik örnekleyip katlanmış (folded) yığın sayaçları toplar; olay döngüsünü neyin tıkadığını bulmak için."""
+    def __init__(self, interval):
+        self.interval = interval; self.samples = Counter(); self.thread = None; self.stop_event = threading.Event(); self.target = threading.main_thread().ident
+
+    @property
+    def running(self): return self.thread is not None
+
+    def start(self):
+        if self.running: return
+        self.samples.clear(); self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run, name="profiler", daemon=True); self.thread.start(); logger.info("Örnekleyici profilci başlatıldı.")
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.target)
+            if frame is None: continue
+            stack = ";".join(f"{f.name} ({os.path.basename(f.filename)}:{f.lineno})" for f in traceback.extract_stack(frame))
+            self.samples[stack] += 1
+
+    def stop(self):
+        """Profilciyi durdurur, sonuçları dosyaya yazar; (dosya yolu, en sık fonksiyonlar) döner."""
+        if not self.running: return None, []
+        self.stop_event.set(); self.thread.join(); self.thread = None
+        path = os.path.join(PROFILE_DIR, f"profile_{datetime.now().strftime('%Y%m%d_%H%M%S')}.folded")
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, n in self.samples.most_common(): f.write(f"{stack} {n}\n")
+        leaf = Counter()
+        for stack, n in self.samples.items(): leaf[stack.rsplit(";", 1)[-1]] += n
+        logger.info(f"Profil kaydedildi: {path}"); return path, leaf.most_common(8)
+
+profiler = SamplingProfiler(PROFILER_INTERVAL)
+
 # --- GLOBAL VERİLER ---
 users, groups = {}, {}
 user_message_counts = {}
 user_words = {}
-dark_mode_users = set()
-# YENİ: Sohbet geçmişi için
-conversation_history = {}
 
 class User:
-    def __init__(self, name=""): self.name = name
+    __slots__ = ("name", "dark_mode")
+    def __init__(self, name="", dark_mode=False): self.name = name; self.dark_mode = dark_mode
 
-def save_json(data, filename):
-    try:
-        with open(filename, "w", encoding="utf-8") as f: json.dump(data, f, ensure_ascii=False, indent=4)
-        logger.info(f"{os.path.basename(filename)} kaydedildi.")
-    except Exception as e: logger.error(f"{os.path.basename(filename)} kayıt hatası: {e}", exc_info=True)
+# --- KELİME FREKANS MOTORU ---
+_TR_LOWER = str.maketrans({"I": "ı", "İ": "i"})
+_WORD_RE = re.compile(r"[^\W\d_]+")
+def tokenize(text):
+    """Türkçe uyumlu küçük harfe çevirme (I→ı, İ→i), noktalama/rakam ayıklama; 3 harften uzun kelimeler, intern edilmiş."""
+    return [sys.intern(w[:64]) for w in _WORD_RE.findall(text.translate(_TR_LOWER).lower()) if len(w) > 3]
+
+class WordSketch:
+    """Space-Saving algoritmasıyla sabit bellekte en sık kelimeleri tutar (en fazla `capacity` sayaç)."""
+    __slots__ = ("capacity", "counts", "errors")
+    _HEADER = struct.Struct("<BHH"); _ITEM = struct.Struct("<IIB"); _VERSION = 1
+
+    def __init__(self, capacity):
+        self.capacity = capacity; self.counts = {}; self.errors = {}
+
+    def add(self, token, n=1):
+        counts = self.counts
+        if token in counts: counts[token] += n; return
+        if len(counts) < self.capacity: counts[token] = n; self.errors[token] = 0; return
+        # Dolu: en küçük sayacı yeni kelimeye devret (tahmin hatası = eski sayaç)
+        victim = min(counts, key=counts.get); floor = counts.pop(victim); del self.errors[victim]
+        counts[token] = floor + n; self.errors[token] = floor
+
+    def merge(self, other):
+        for token, n in other.counts.items(): self.add(token, n)
+        return self
+
+    def top(self, k): return heapq.nlargest(k, self.counts.items(), key=lambda kv: kv[1])
+
+    def to_bytes(self):
+        parts = [self._HEADER.pack(self._VERSION, self.capacity, len(self.counts))]
+        for token, n in self.counts.items():
+            raw = token.encode("utf-8")[:255]; parts.append(self._ITEM.pack(n, self.errors.get(token, 0), len(raw))); parts.append(raw)
+        return b"".join(parts)
+
+    @classmethod
+    def from_bytes(cls, data):
+        _, capacity, n = cls._HEADER.unpack_from(data, 0); sketch = cls(capacity); off = cls._HEADER.size
+        for _ in range(n):
+            count, err, size = cls._ITEM.unpack_from(data, off); off += cls._ITEM.size
+            token = sys.intern(data[off:off + size].decode("utf-8", "ignore")); off += size
+            sketch.counts[token] = count; sketch.errors[token] = err
+        return sketch
+
+    @classmethod
+    def from_counts(cls, counts, capacity):
+        """Eski sınırsız {kelime: sayı} sözlüğünden en sık `capacity` kelimeyi alır."""
+        sketch = cls(capacity)
+        for token, n in heapq.nlargest(capacity, counts.items(), key=lambda kv: kv[1]): sketch.counts[sys.intern(token)] = n; sketch.errors[token] = 0
+        return sketch
+
+    @classmethod
+    def load(cls, data, capacity):
+        if not data: return cls(capacity)
+        if isinstance(data, str): return cls.from_counts(json.loads(data), capacity)  # eski JSON biçimi
+        return cls.from_bytes(data)
+
+# --- KALICI VERİ DEPOSU (SQLite/WAL) ---
+class DataStore:
+    """SQLite deposu. WAL modunda: okumalar olay döngüsünde, yazmalar ayrı iş parçacığında ayrı bağlantıyla yapılır."""
+    def __init__(self, path):
+        self.path = path; self.reader = self.writer = None
+        self.write_lock = threading.Lock()  # yazıcı bağlantı aynı anda tek iş parçacığında kullanılır
+        self.rows_written = 0; self.flushes = 0
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL"); conn.execute("PRAGMA synchronous=NORMAL"); return conn
+
+    def open(self):
+        self.writer = self._connect()
+        with self.writer:
+            self.writer.execute("CREATE TABLE IF NOT EXISTS users (uid INTEGER PRIMARY KEY, name TEXT, message_count INTEGER NOT NULL DEFAULT 0, words BLOB, dark_mode INTEGER NOT NULL DEFAULT 0)")
+            if "dark_mode" not in {row[1] for row in self.writer.execute("PRAGMA table_info(users)")}: self.writer.execute("ALTER TABLE users ADD COLUMN dark_mode INTEGER NOT NULL DEFAULT 0")
+            self.writer.execute("CREATE TABLE IF NOT EXISTS word_sketches (scope TEXT PRIMARY KEY, day TEXT, data BLOB)")
+            self.writer.execute("CREATE TABLE IF NOT EXISTS groups (gid INTEGER PRIMARY KEY, title TEXT)")
+            self.writer.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            self.writer.execute("CREATE TABLE IF NOT EXISTS conversations (uid INTEGER PRIMARY KEY, summary TEXT, turns TEXT, pending TEXT)")
+            self.writer.execute("CREATE TABLE IF NOT EXISTS broadcasts (bid INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT, text TEXT, status TEXT, admin_chat INTEGER, status_msg INTEGER, created REAL, sent INTEGER DEFAULT 0, failed INTEGER DEFAULT 0, pruned INTEGER DEFAULT 0)")
+            self.writer.execute("CREATE TABLE IF NOT EXISTS broadcast_done (bid INTEGER, chat_id INTEGER, PRIMARY KEY (bid, chat_id))")
+            # Botun geneli ("0:" kapsamları) artık sadece grup mesajlarından oluşur; özel mesaj içeren eski sayaçlar bir kez silinir
+            if not self.writer.execute("SELECT 1 FROM meta WHERE key = 'global_words_groups_only'").fetchone():
+                self.writer.execute("DELETE FROM word_sketches WHERE scope LIKE '0:%'"); self.writer.execute("INSERT INTO meta (key, value) VALUES ('global_words_groups_only', '1')")
+        self.reader = self._connect()
+
+    def close(self):
+        for conn in (self.reader, self.writer):
+            if conn is not None: conn.close()
+        self.reader = self.writer = None
+
+    def get_meta(self, key):
+        row = self.reader.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone(); return row[0] if row else None
+
+    def load_user(self, uid): return self.reader.execute("SELECT name, message_count, words, dark_mode FROM users WHERE uid = ?", (uid,)).fetchone()
+    def load_groups(self): return {gid: {"title": title} for gid, title in self.reader.execute("SELECT gid, title FROM groups")}
+    def user_ids(self): return [row[0] for row in self.reader.execute("SELECT uid FROM users ORDER BY uid")]
+    def load_conversation(self, uid): return self.reader.execute("SELECT summary, turns, pending FROM conversations WHERE uid = ?", (uid,)).fetchone()
+    def load_sketch(self, scope):
+        row = self.reader.execute("SELECT data FROM word_sketches WHERE scope = ?", (scope,)).fetchone(); return row[0] if row else None
+    def load_sketch_shards(self, scope):
+        """Kapsamın tüm işçi kopyaları: "<kapsam>" ve "<kapsam>@<işçi>" satırları."""
+        return self.reader.execute("SELECT scope, data FROM word_sketches WHERE scope = ? OR scope LIKE ?", (scope, scope + "@%")).fetchall()
+    def user_totals(self): return self.reader.execute("SELECT COUNT(*), COALESCE(SUM(message_count), 0) FROM users").fetchone()
+
+    def write(self, user_rows=(), group_rows=(), meta_rows=(), sketch_rows=(), conv_rows=(), prune_before=None):
+        """Kirli satırları tek işlemde (transaction) yazar. İş parçacığından çağrılır."""
+        t0 = perf_counter()
+        with self.write_lock, self.writer:
+            self.writer.executemany("INSERT INTO conversations (uid, summary, turns, pending) VALUES (?, ?, ?, ?) ON CONFLICT(uid) DO UPDATE SET summary = excluded.summary, turns = excluded.turns, pending = excluded.pending", conv_rows)
+            self.writer.executemany("INSERT INTO word_sketches (scope, day, data) VALUES (?, ?, ?) ON CONFLICT(scope) DO UPDATE SET data = excluded.data", sketch_rows)
+            if prune_before: self.writer.execute("DELETE FROM word_sketches WHERE day IS NOT NULL AND day < ?", (prune_before,))
+            self.writer.executemany("INSERT INTO users (uid, name, message_count, words, dark_mode) VALUES (?, ?, ?, ?, ?) ON CONFLICT(uid) DO UPDATE SET name = excluded.name, message_count = excluded.message_count, words = excluded.words, dark_mode = excluded.dark_mode", user_rows)
+            self.writer.executemany("INSERT INTO groups (gid, title) VALUES (?, ?) ON CONFLICT(gid) DO UPDATE SET title = excluded.title", group_rows)
+            self.writer.executemany("INSERT INTO meta (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value", meta_rows)
+        rows = len(user_rows) + len(group_rows) + len(sketch_rows) + len(conv_rows); self.rows_written += rows; self.flushes += 1
+        metrics.inc("store_rows_written_total", rows)
+        metrics.observe("store_write_seconds", perf_counter() - t0)
+        metrics.inc("store_bytes_written_total", sum(len(v) for rows in (user_rows, group_rows, sketch_rows, conv_rows) for row in rows for v in row if isinstance(v, (str, bytes))))
+
+    def create_broadcast(self, kind, text, admin_chat=None, status_msg=None):
+        with self.write_lock, self.writer:
+            return self.writer.execute("INSERT INTO broadcasts (kind, text, status, admin_chat, status_msg, created) VALUES (?, ?, 'running', ?, ?, ?)", (kind, text, admin_chat, status_msg, datetime.now(timezone.utc).timestamp())).lastrowid
+    def load_broadcast(self, bid): return self.reader.execute("SELECT kind, text, admin_chat, status_msg, sent, failed, pruned FROM broadcasts WHERE bid = ?", (bid,)).fetchone()
+    def running_broadcasts(self): return [row[0] for row in self.reader.execute("SELECT bid FROM broadcasts WHERE status = 'running' ORDER BY bid")]
+    def broadcast_done_ids(self, bid): return {row[0] for row in self.reader.execute("SELECT chat_id FROM broadcast_done WHERE bid = ?", (bid,))}
+
+    def record_broadcast(self, bid, done_ids, sent, failed, pruned, status="running"):
+        """Duyuru ilerlemesini kaydeder; yeniden başlatmada gönderilenler atlanır. İş parçacığından çağrılır."""
+        with self.write_lock, self.writer:
+            self.writer.executemany("INSERT OR IGNORE INTO broadcast_done (bid, chat_id) VALUES (?, ?)", [(bid, cid) for cid in done_ids])
+            self.writer.execute("UPDATE broadcasts SET sent = ?, failed = ?, pruned = ?, status = ? WHERE bid = ?", (sent, failed, pruned, status, bid))
+            if status != "running": self.writer.execute("DELETE FROM broadcast_done WHERE bid = ?", (bid,))
+
+    def delete_chats(self, user_ids=(), group_ids=()):
+        with self.write_lock, self.writer:
+            self.writer.executemany("DELETE FROM users WHERE uid = ?", [(i,) for i in user_ids])
+            self.writer.executemany("DELETE FROM groups WHERE gid = ?", [(i,) for i in group_ids])
+
+    def migrate_json(self):
+        """Eski users_data.json / groups.json dosyalarını tek seferlik içeri aktarır."""
+        if self.get_meta("json_migrated"): return
+        user_rows, group_rows = [], []
+        try:
+            if os.path.exists(USERS_FILE):
+                with open(USERS_FILE, "r", encoding="utf-8") as f:
+                    user_rows = [(int(k), v.get('name'), v.get('message_count', 0), WordSketch.from_counts(v.get('words', {}), WORD_SKETCH_USER_CAPACITY).to_bytes(), 0) for k, v in json.load(f).items()]
+            if os.path.exists(GROUPS_FILE):
+                with open(GROUPS_FILE, "r", encoding="utf-8") as f: group_rows = [(int(k), v.get('title')) for k, v in json.load(f).items()]
+        except (OSError, json.JSONDecodeError, UnicodeDecodeError) as e:
+            # Bayrak yazılmaz: dosya düzeltilince bir sonraki açılışta aktarım yeniden denenir
+            logger.warning(f"Eski JSON veri dosyası okunamadı ({e}), aktarım bu açılışta atlandı."); return
+        self.write(user_rows, group_rows, [("json_migrated", "1")])
+        logger.info(f"JSON verileri SQLite'a aktarıldı: {len(user_rows)} kullanıcı, {len(group_rows)} grup.")
+
+store = DataStore(DB_FILE)
+dirty_users, dirty_groups = set(), set()
 
 def load_data():
-    global users, groups, current_model, user_message_counts, user_words
-    try:
-        if os.path.exists(USERS_FILE):
-            with open(USERS_FILE, "r", encoding="utf-8") as f: 
-                raw_users = json.load(f)
-                users = {int(k): User(v.get('name')) for k, v in raw_users.items()}
-                user_message_counts = {int(k): v.get('message_count', 0) for k, v in raw_users.items()}
-                user_words = {int(k): v.get('words', {}) for k, v in raw_users.items()}
-        if os.path.exists(GROUPS_FILE):
-            with open(GROUPS_FILE, "r", encoding="utf-8") as f: groups = {int(k): v for k, v in json.load(f).items()}
-    except (json.JSONDecodeError, UnicodeDecodeError) as e:
-        logger.warning(f"Veri dosyası okunurken hata ({e}). Yeni dosyalar oluşturulacak.")
-        users, groups, user_message_counts, user_words = {}, {}, {}, {}
-    current_model = os.getenv("DEFAULT_AI_MODEL", "openrouter")
-    logger.info(f"{len(users)} kullanıcı, {len(groups)} grup yüklendi. Aktif AI: {current_model.upper()}")
+    """Depoyu açar; gruplar küçük olduğu için hemen, kullanıcılar ilk erişimde (tembel) yüklenir."""
+    global groups, current_model
+    store.open(); store.migrate_json()
+    groups = store.load_groups()
+    current_model = (store.get_meta("ai_model") if WORKER_ID is not None else None) or os.getenv("DEFAULT_AI_MODEL", "openrouter")
+    logger.info(f"{store.user_totals()[0]} kullanıcı kayıtlı, {len(groups)} grup yüklendi. Aktif AI: {current_model.upper()}")
 
 def get_or_create_user(uid, name):
-    if uid not in users: 
+    if uid in users: return users[uid]
+    row = store.load_user(uid) if store.reader is not None else None
+    if row:
+        users[uid] = User(row[0], bool(row[3])); user_message_counts[uid] = row[1]
+        user_words[uid] = WordSketch.load(row[2], WORD_SKETCH_USER_CAPACITY)
+    else:
         users[uid] = User(name)
         user_message_counts[uid] = 0
-        user_words[uid] = {}
-        conversation_history[uid] = deque(maxlen=4) # Her yeni kullanıcı için hafıza oluştur
+        user_words[uid] = WordSketch(WORD_SKETCH_USER_CAPACITY)
+        dirty_users.add(uid)
     return users.get(uid)
 
-def save_all_data():
-    users_with_data = {
-        uid: {
-            **user.__dict__, 
-            'message_count': user_message_counts.get(uid, 0),
-            'words': user_words.get(uid, {})
-        } for uid, user in users.items()
+def mark_user_dirty(uid): dirty_users.add(uid)
+def mark_group_dirty(gid): dirty_groups.add(gid)
+
+def _has_dirty(): return bool(dirty_users or dirty_groups or dirty_scopes or conversation_memory.has_dirty())
+
+def _collect_dirty():
+    """Kirli satırların anlık görüntüsünü olay döngüsünde alır, kümeleri boşaltır."""
+    t0 = perf_counter()
+    rows = {
+        "user_rows": [(uid, users[uid].name, user_message_counts.get(uid, 0), user_words[uid].to_bytes() if uid in user_words else None, int(users[uid].dark_mode)) for uid in dirty_users if uid in users],
+        "group_rows": [(gid, groups[gid]['title']) for gid in dirty_groups if gid in groups],
+        "sketch_rows": [(_scope_key(scope), _scope_day(scope), word_scopes[scope].to_bytes()) for scope in dirty_scopes if scope in word_scopes],
+        "conv_rows": conversation_memory.collect_rows(),
     }
-    save_json(users_with_data, USERS_FILE)
-    save_json(groups, GROUPS_FILE)
+    dirty_users.clear(); dirty_groups.clear(); dirty_scopes.clear()
+    metrics.observe("store_loop_blocked_seconds", perf_counter() - t0)  # olay döngüsünün kayıt için bloklandığı süre
+    return rows
+
+def _requeue_dirty(rows):
+    dirty_users.update(r[0] for r in rows["user_rows"]); dirty_groups.update(r[0] for r in rows["group_rows"])
+    dirty_scopes.update(r[0].split("@")[0] for r in rows["sketch_rows"]); conversation_memory.requeue(rows["conv_rows"])
+
+_flush_lock = asyncio.Lock()  # anlık görüntü + yazım tek seferde: eski görüntü yenisinin üstüne yazılamaz
+async def flush_data(context=None):
+    """Write-behind: kirli satırları ayrı iş parçacığında toplu yazar (JobQueue ile periyodik çalışır)."""
+    async with _flush_lock:
+        if store.writer is None or not _has_dirty(): return
+        rows = _collect_dirty()
+        try: await asyncio.to_thread(store.write, **rows)
+        except Exception as e: logger.error(f"Veri kayıt hatası: {e}", exc_info=True); _requeue_dirty(rows)
+
+def save_all_data():
+    """Kalan kirli satırları eşzamanlı yazar; sadece kapanışta kullanılır."""
+    if store.writer is None or not _has_dirty(): return
+    t0 = perf_counter()
+    try: store.write(**_collect_dirty()); logger.info("Veriler kaydedildi.")
+    except Exception as e: logger.error(f"Veri kayıt hatası: {e}", exc_info=True)
+    finally: metrics.observe("store_sync_save_seconds", perf_counter() - t0)
+
+# Sohbet geneli ve günlük kelime sayaçları. Kapsam anahtarı: "<chat_id>:all" veya "<chat_id>:d:<YYYY-MM-DD>"; chat_id=0 botun tamamıdır.
+# Çok işçili modda her işçi kendi kopyasını "<kapsam>@<işçi>" satırına yazar, sıralamalar okurken birleştirilir.
+word_scopes, dirty_scopes = {}, set()
+def _today(): return datetime.now(TURKEY_TZ).date()
+def _scope_day(scope): parts = scope.split(":"); return parts[2] if len(parts) == 3 and parts[1] == "d" else None
+def _scope_key(scope): return scope if WORKER_ID is None else f"{scope}@{WORKER_ID}"
+def get_scope_sketch(scope):
+    sketch = word_scopes.get(scope)
+    if sketch is None:
+        data = store.load_sketch(_scope_key(scope)) if store.reader is not None else None
+        sketch = word_scopes[scope] = WordSketch.load(data, WORD_SKETCH_SCOPE_CAPACITY)
+    return sketch
+
+def scope_view(scope):
+    """Kapsamın bu işçideki hali + diğer işçilerin diske yazdığı kopyalar (tek süreçte sadece kendi hali)."""
+    sketch = get_scope_sketch(scope)
+    if WORKER_ID is None or store.reader is None: return sketch
+    merged = WordSketch(WORD_SKETCH_SCOPE_CAPACITY).merge(sketch); own = _scope_key(scope)
+    for key, data in store.load_sketch_shards(scope):
+        if key != own: merged.merge(WordSketch.load(data, WORD_SKETCH_SCOPE_CAPACITY))
+    return merged
+
+def record_words(uid, chat_id, text):
+    """Mesajdaki kelimeleri kullanıcı, sohbet ve botun geneli için (tüm zamanlar + bugün) sayar.
+    chat_id=0 özel sohbettir: özel mesajlar sadece kullanıcının kendi sayacına girer, botun geneli gruplardan oluşur."""
+    tokens = tokenize(text)
+    if not tokens: return
+    sketch = user_words[uid]; day = _today().isoformat()
+    scopes = {f"{chat_id}:all", f"{chat_id}:d:{day}", f"0:all", f"0:d:{day}"} if chat_id else set()
+    targets = [get_scope_sketch(scope) for scope in scopes]
+    for token in tokens:
+        sketch.add(token)
+        for target in targets: target.add(token)
+    dirty_scopes.update(scopes)
+
+def top_words(chat_id, window, k=10):
+    """window: 'd' (bugün), 'w' (son 7 gün) veya 'a' (tüm zamanlar)."""
+    if window == "a": return scope_view(f"{chat_id}:all").top(k)
+    days = 1 if window == "d" else 7; today = _today(); merged = WordSketch(WORD_SKETCH_SCOPE_CAPACITY)
+    for i in range(days): merged.merge(scope_view(f"{chat_id}:d:{(today - timedelta(days=i)).isoformat()}"))
+    return merged.top(k)
+
+async def prune_word_stats(context):
+    """Saklama süresini geçen günlük kovaları bellekten ve diskten siler (günlük iş)."""
+    cutoff = (_today() - timedelta(days=max(WORD_DAYS_KEPT, 7))).isoformat()
+    for scope in [s for s in word_scopes if (_scope_day(s) or cutoff) < cutoff]: del word_scopes[scope]; dirty_scopes.discard(scope)
+    if store.writer is not None: await asyncio.to_thread(store.write, prune_before=cutoff)
+
+# --- SOHBET HAFIZASI ---
+def estimate_tokens(text): return len(text) // 4 + 4  # kabaca 4 karakter ≈ 1 token, mesaj başına sabit ek yük
+
+class Conversation:
+    __slots__ = ("summary", "turns", "pending", "last_used", "summarizing")
+    def __init__(self, summary="", turns=(), pending=()):
+        self.summary = summary; self.turns = deque(turns); self.pending = list(pending)  # pending: pencereden düşen, henüz özete katılmamış mesajlar
+        self.last_used = 0.0; self.summarizing = False
+
+    def tokens(self): return sum(estimate_tokens(t["content"]) for t in self.turns)
+    def row(self, uid): return (uid, self.summary, json.dumps(list(self.turns), ensure_ascii=False), json.dumps(self.pending, ensure_ascii=False))
+
+class ConversationMemory:
+    """Kullanıcı başına token bütçeli sohbet geçmişi: son mesajlar + eski mesajların kayan özeti.
+    Aktif kullanıcılar LRU ile bellekte tutulur; boşta kalanlar diske yazılıp bellekten atılır, sonraki mesajda geri yüklenir."""
+    def __init__(self, budget, hot_users, idle_seconds):
+        self.budget = budget; self.hot_users = hot_users; self.idle_seconds = idle_seconds
+        self.hot = OrderedDict(); self.dirty = set()
+        self.evicted = {}  # uid -> diske henüz yazılmamış, bellekten atılmış satır
+        self.loads = 0; self.evictions = 0; self.summaries = 0
+
+    def get(self, uid):
+        conv = self.hot.get(uid)
+        if conv is None:
+            row = self.evicted.get(uid)
+            row = row[1:] if row else (store.load_conversation(uid) if store.reader is not None else None)
+            conv = Conversation(row[0] or "", json.loads(row[1] or "[]"), json.loads(row[2] or "[]")) if row else Conversation()
+            if row: self.loads += 1
+            self.hot[uid] = conv
+            if len(self.hot) > self.hot_users:
+                # LRU taşması: özeti süren sohbetler atlanır, yoksa özet bellekten düşmüş nesneye yazılıp kaybolur
+                victims = (v for v, c in self.hot.items() if not c.summarizing and v != uid)
+                for victim in list(itertools.islice(victims, len(self.hot) - self.hot_users)): self._evict(victim)
+        self.hot.move_to_end(uid); conv.last_used = _monotonic(); return conv
+
+    def _evict(self, uid):
+        conv = self.hot.pop(uid)
+        if uid in self.dirty: self.evicted[uid] = conv.row(uid); self.dirty.discard(uid)
+        self.evictions += 1
+
+    def evict_idle(self):
+        cutoff = _monotonic() - self.idle_seconds
+        for uid in [uid for uid, conv in self.hot.items() if conv.last_used < cutoff and not conv.summarizing]: self._evict(uid)
+
+    def prompts(self, uid, system_prompt):
+        conv = self.get(uid)
+        if conv.summary: system_prompt += f"\n# ÖNCEKİ KONUŞMANIN ÖZETİ\n{conv.summary}\n"
+        return [{"role": "system", "content": system_prompt}, *conv.turns]
+
+    def append(self, uid, user_message, response):
+        """Mesaj çiftini ekler, bütçeyi aşan en eski mesajları özet kuyruğuna atar. Özetleme gerekiyorsa True döner."""
+        conv = self.get(uid)
+        conv.turns.append({"role": "user", "content": user_message}); conv.turns.append({"role": "assistant", "content": response})
+        while len(conv.turns) > 2 and conv.tokens() > self.budget: conv.pending.extend((conv.turns.popleft(), conv.turns.popleft()))  # kullanıcı+cevap çifti halinde
+        self.dirty.add(uid)
+        return not conv.summarizing and sum(estimate_tokens(t["content"]) for t in conv.pending) >= HISTORY_SUMMARIZE_AFTER
+
+    async def summarize(self, uid):
+        """Bekleyen eski mesajları önceki özetle birleştirip tek bir kısa özete indirger."""
+        conv = self.get(uid)
+        if conv.summarizing or not conv.pending: return
+        conv.summarizing = True; batch = conv.pending[:]
+        transcript = "\n".join(f"{'Kullanıcı' if t['role'] == 'user' else 'DarkJarvis'}: {t['content']}" for t in batch)
+        prompts = _prompt(f"Bir sohbetin hafıza özetini tutuyorsun. Önceki özeti ve yeni mesajları birleştirip kullanıcı hakkında önemli bilgileri, konuları ve tonu koruyan, en fazla {HISTORY_SUMMARY_TOKENS * 3} karakterlik tek bir Türkçe özet yaz. Sadece özeti yaz.",
+                          f"Önceki özet:\n{conv.summary or '(yok)'}\n\nYeni mesajlar:\n{transcript}")
+        provider = active_provider()
+        try:
+            if not AI_PROVIDERS[provider]["key"]: raise RuntimeError(AI_PROVIDERS[provider]["missing"])
+            async with ai_scheduler.slot(0, provider): summary = (await _chat(provider, prompts)).strip()
+        except Exception as e:
+            # AI'a ulaşılamazsa son mesajları kırpıp özet yerine kullan
+            logger.warning(f"Sohbet özeti çıkarılamadı ({uid}): {e}"); summary = f"{conv.summary}\n{transcript}".strip()[-HISTORY_SUMMARY_TOKENS * 4:]
+        finally: conv.summarizing = False
+        conv.summary = summary[:HISTORY_SUMMARY_TOKENS * 4]; del conv.pending[:len(batch)]; self.summaries += 1
+        if self.hot.get(uid) is conv: self.dirty.add(uid)
+        else: self.evicted[uid] = conv.row(uid)  # özetlenirken bellekten düştüyse sonuç yine diske yazılsın
+
+    def has_dirty(self): return bool(self.dirty or self.evicted)
+
+    def collect_rows(self):
+        rows = dict(self.evicted); self.evicted.clear()
+        for uid in self.dirty:
+            if uid in self.hot: rows[uid] = self.hot[uid].row(uid)
+        self.dirty.clear(); return list(rows.values())
+
+    def requeue(self, rows):
+        for row in rows:
+            if row[0] not in self.hot: self.evicted.setdefault(row[0], row)
+            else: self.dirty.add(row[0])
+
+    def stats(self): return {"hot": len(self.hot), "loads": self.loads, "evictions": self.evictions, "summaries": self.summaries}
+
+conversation_memory = ConversationMemory(HISTORY_TOKEN_BUDGET, HISTORY_HOT_USERS, HISTORY_IDLE_SECONDS)
+def conversation_memory_stats_text(): st = conversation_memory.stats(); return f"bellekte {st['hot']} kişi, diskten yükleme {st['loads']}, tahliye {st['evictions']}, özet {st['summaries']}"
+async def evict_idle_conversations(context): conversation_memory.evict_idle()
 
 def imzali(metin): return f"{metin}\n\n🤖 DarkJarvis | Kurucu: ✘𝙐𝙂𝙐𝙍"
 
-async def _get_openrouter_response(prompts):
-    if not OPENROUTER_API_KEY: return "OpenRouter API anahtarı eksik."
-    headers = {"Authorization": f"Bearer {OPENROUTER_API_KEY}"}; payload = {"model": "google/gemini-flash-1.5", "messages": prompts}
-    async with httpx.AsyncClient() as c: r = await c.post("https://openrouter.ai/api/v1/chat/completions", headers=headers, json=payload, timeout=40); r.raise_for_status(); return r.json()["choices"][0]["message"]["content"]
-async def _get_venice_response(prompts):
-    if not VENICE_API_KEY: return "Venice AI API anahtarı eksik."
-    url = "https://api.venice.ai/v1/chat/completions"; headers = {"Authorization": f"Bearer {VENICE_API_KEY}"}
-    payload = {"model": "venice-gpt-4", "messages": prompts}
-    async with httpx.AsyncClient() as c: r = await c.post(url, headers=headers, json=payload, timeout=40); r.raise_for_status(); return r.json()["choices"][0]["message"]["content"]
-async def get_ai_response(prompts):
-    try:
-        logger.info(f"AI isteği gönderiliyor. Aktif Model: {current_model.upper()}")
-        if current_model == "venice": return await _get_venice_response(prompts)
-        return await _get_openrouter_response(prompts)
-    except httpx.HTTPStatusError as e: 
-        logger.error(f"AI API'den HTTP hatası ({current_model}): {e.response.status_code} - {e.response.text}")
+# --- AI HTTP HAVUZU ---
+class AIClientPool:
+    """Bir AI sağlayıcısı için uzun ömürlü, keep-alive/HTTP2 havuzlu httpx istemcisi."""
+    def __init__(self, name):
+        self.name = name; self.client = None
+        self.in_use = 0; self.requests = 0; self.errors = 0
+
+    def start(self):
+        if self.client is not None: return self.client
+        http2 = AI_HTTP2
+        if http2:
+            try: import h2  # noqa: F401
+            except ImportError: logger.warning("h2 paketi yok, HTTP/1.1 keep-alive kullanılacak."); http2 = False
+        limits = httpx.Limits(max_connections=AI_MAX_CONNECTIONS, max_keepalive_connections=AI_MAX_KEEPALIVE, keepalive_expiry=AI_KEEPALIVE_EXPIRY)
+        timeout = httpx.Timeout(connect=AI_CONNECT_TIMEOUT, read=AI_READ_TIMEOUT, write=AI_WRITE_TIMEOUT, pool=AI_POOL_TIMEOUT)
+        self.client = httpx.AsyncClient(http2=http2, limits=limits, timeout=timeout)
+        logger.info(f"{self.name} HTTP havuzu açıldı (http2={http2}, max={AI_MAX_CONNECTIONS}, keepalive={AI_MAX_KEEPALIVE}).")
+        return self.client
+
+    def _trace_acquire(self, kwargs):
+        """httpcore trace ile havuzdan bağlantı (HTTP/2'de akış) alınana kadar geçen süreyi ai_pool_acquire_seconds'a yazar."""
+        t0 = perf_counter(); seen = False
+        async def trace(event, info):
+            nonlocal seen
+            # Yeni bağlantı kurulmaya başladı ya da mevcut bağlantıda istek gönderiliyor: havuz beklemesi bitti
+            if not seen and event.endswith((".connect_tcp.started", ".send_request_headers.started")):
+                seen = True; metrics.observe("ai_pool_acquire_seconds", perf_counter() - t0, provider=self.name)
+        kwargs.setdefault("extensions", {})["trace"] = trace
+        return kwargs
+
+    async def post(self, url, **kwargs):
+        client = self.start()
+        self.in_use += 1; self.requests += 1
+        try: return await client.post(url, **self._trace_acquire(kwargs))
+        except Exception: self.errors += 1; raise
+        finally: self.in_use -= 1
+
+    @contextlib.asynccontextmanager
+    async def stream(self, url, **kwargs):
+        client = self.start()
+        self.in_use += 1; self.requests += 1
+        try:
+            async with client.stream("POST", url, **self._trace_acquire(kwargs)) as r: yield r
+        except Exception: self.errors += 1; raise
+        finally: self.in_use -= 1
+
+    def stats(self):
+        idle = active = 0
+        pool = getattr(getattr(self.client, "_transport", None), "_pool", None)
+        for conn in getattr(pool, "connections", []):
+            if conn.is_idle(): idle += 1
+            else: active += 1
+        return {"in_use": self.in_use, "idle": idle, "active": active, "requests": self.requests, "errors": self.errors}
+
+    async def close(self):
+        if self.client is not None: await self.client.aclose(); self.client = None; logger.info(f"{self.name} HTTP havuzu kapatıldı.")
+
+ai_clients = {"openrouter": AIClientPool("openrouter"), "venice": AIClientPool("venice")}
+
+def ai_pool_stats_text():
+    lines = []
+    for name, pool in ai_clients.items():
+        st = pool.stats(); lines.append(f"- {name}: kullanımda {st['in_use']}, boşta {st['idle']}, aktif {st['active']}, istek {st['requests']}, hata {st['errors']}")
+    return "\n".join(lines) + "\nBağlantı alma süresi:\n" + metrics.summary({"ai_pool_acquire_seconds"})
+
+AI_PROVIDERS = {
+    "openrouter": {"url": "https://openrouter.ai/api/v1/chat/completions", "model": "google/gemini-flash-1.5", "key": OPENROUTER_API_KEY, "missing": "OpenRouter API anahtarı eksik."},
+    "venice": {"url": "https://api.venice.ai/v1/chat/completions", "model": "venice-gpt-4", "key": VENICE_API_KEY, "missing": "Venice AI API anahtarı eksik."},
+}
+def active_provider(): return current_model if current_model in AI_PROVIDERS else "openrouter"
+
+# --- AI İSTEK ZAMANLAYICISI ---
+class AIQueueFull(Exception): pass
+
+class AIScheduler:
+    """Global ve sağlayıcı başına eşzamanlılık sınırı koyan, kullanıcılar arasında sırayla (round-robin) slot dağıtan kuyruk."""
+    def __init__(self, max_inflight, provider_max_inflight, max_queue):
+        self.max_inflight = max_inflight; self.provider_max_inflight = provider_max_inflight; self.max_queue = max_queue
+        self.queues = OrderedDict()  # uid -> deque[(provider, future)]
+        self.inflight = 0; self.provider_inflight = Counter()
+        self.granted = 0; self.rejected = 0; self.retries = 0; self.peak_depth = 0
+
+    def depth(self): return sum(len(q) for q in self.queues.values())
+
+    @contextlib.asynccontextmanager
+    async def slot(self, uid, provider):
+        depth = self.depth()
+        if depth >= self.max_queue: self.rejected += 1; logger.warning(f"AI kuyruğu dolu ({depth}), istek reddedildi."); raise AIQueueFull()
+        fut = asyncio.get_running_loop().create_future(); t0 = perf_counter()
+        self.queues.setdefault(uid, deque()).append((provider, fut)); self.peak_depth = max(self.peak_depth, depth + 1)
+        self._dispatch()
+        try: await fut; metrics.observe("ai_queue_wait_seconds", perf_counter() - t0, provider=provider)
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled(): self._release(provider)
+            else: self._forget(uid, fut)
+            raise
+        try: yield
+        finally: self._release(provider)
+
+    def _forget(self, uid, fut):
+        q = self.queues.get(uid)
+        if q is None: return
+        self.queues[uid] = deque(item for item in q if item[1] is not fut)
+        if not self.queues[uid]: del self.queues[uid]
+
+    def _release(self, provider):
+        self.inflight -= 1; self.provider_inflight[provider] -= 1; self._dispatch()
+
+    def _dispatch(self):
+        # Her turda sıradaki kullanıcının ilk isteğine slot ver, kullanıcıyı sona at
+        progressed = True
+        while progressed and self.inflight < self.max_inflight:
+            progressed = False
+            for uid in list(self.queues):
+                q = self.queues[uid]; provider, fut = q[0]
+                if not fut.cancelled() and self.provider_inflight[provider] >= self.provider_max_inflight: continue
+                q.popleft()
+                if q: self.queues.move_to_end(uid)
+                else: del self.queues[uid]
+                if fut.cancelled(): progressed = True; break
+                self.inflight += 1; self.provider_inflight[provider] += 1; self.granted += 1
+                fut.set_result(None); progressed = True; break
+
+    def stats(self):
+        return {"inflight": self.inflight, "queued": self.depth(), "users_waiting": len(self.queues), "peak_queue": self.peak_depth,
+                "granted": self.granted, "rejected": self.rejected, "retries": self.retries,
+                "per_provider": {p: self.provider_inflight[p] for p in AI_PROVIDERS}}
+
+ai_scheduler = AIScheduler(AI_MAX_INFLIGHT, AI_PROVIDER_MAX_INFLIGHT, AI_MAX_QUEUE)
+
+def ai_scheduler_stats_text():
+    st = ai_scheduler.stats(); per = ", ".join(f"{p}: {n}" for p, n in st["per_provider"].items())
+    return f"- Çalışan: {st['inflight']}/{AI_MAX_INFLIGHT} ({per})\n- Kuyrukta: {st['queued']} ({st['users_waiting']} kullanıcı, zirve {st['peak_queue']})\n- Verilen slot: {st['granted']}, reddedilen: {st['rejected']}, tekrar deneme: {st['retries']}"
+
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+def _retry_delay(attempt, response=None):
+    """Retry-After başlığına uyar; yoksa üstel geri çekilme + tam jitter."""
+    header = response.headers.get("Retry-After") if response is not None else None
+    if header:
+        try: return min(float(header), AI_RETRY_MAX_DELAY)
+        except ValueError:
+            try: return min(max((parsedate_to_datetime(header) - datetime.now(timezone.utc)).total_seconds(), 0), AI_RETRY_MAX_DELAY)
+            except (TypeError, ValueError): pass
+    return random.uniform(0, min(AI_RETRY_MAX_DELAY, AI_RETRY_BASE_DELAY * 2 ** attempt))
+
+async def _chat(provider, prompts):
+    t0 = perf_counter()
+    try: return await _chat_request(provider, prompts)
+    finally: metrics.observe("ai_request_seconds", perf_counter() - t0, provider=provider)
+async def _chat_request(provider, prompts):
+    cfg = AI_PROVIDERS[provider]
+    if not cfg["key"]: return cfg["missing"]
+    headers = {"Authorization": f"Bearer {cfg['key']}"}; payload = {"model": cfg["model"], "messages": prompts}
+    for attempt in range(AI_MAX_RETRIES + 1):
+        r = await ai_clients[provider].post(cfg["url"], headers=headers, json=payload)
+        if r.status_code in RETRYABLE_STATUS and attempt < AI_MAX_RETRIES:
+            delay = _retry_delay(attempt, r); ai_scheduler.retries += 1
+            logger.warning(f"AI {provider} {r.status_code} döndü, {delay:.1f} sn sonra tekrar denenecek ({attempt + 1}/{AI_MAX_RETRIES})."); await asyncio.sleep(delay); continue
+        r.raise_for_status(); return r.json()["choices"][0]["message"]["content"]
+async def _stream_chat(provider, prompts):
+    """OpenAI uyumlu SSE akışını okur, gelen metin parçalarını sırayla verir."""
+    cfg = AI_PROVIDERS[provider]
+    if not cfg["key"]: yield cfg["missing"]; return
+    headers = {"Authorization": f"Bearer {cfg['key']}"}; payload = {"model": cfg["model"], "messages": prompts, "stream": True}
+    for attempt in range(AI_MAX_RETRIES + 1):
+        async with ai_clients[provider].stream(cfg["url"], headers=headers, json=payload) as r:
+            if r.status_code in RETRYABLE_STATUS and attempt < AI_MAX_RETRIES: await r.aread(); delay = _retry_delay(attempt, r)
+            else:
+                if r.status_code >= 400: await r.aread(); r.raise_for_status()
+                async for line in r.aiter_lines():
+                    if not line.startswith("data:"): continue  # boş satırlar ve ": PROCESSING" yorumları
+                    data = line[5:].strip()
+                    if data == "[DONE]": break
+                    try: delta = json.loads(data)["choices"][0].get("delta", {}).get("content")
+                    except (ValueError, KeyError, IndexError): continue
+                    if delta: yield delta
+                return
+        ai_scheduler.retries += 1
+        logger.warning(f"AI {provider} {r.status_code} döndü, {delay:.1f} sn sonra tekrar denenecek ({attempt + 1}/{AI_MAX_RETRIES})."); await asyncio.sleep(delay)
+
+def _ai_error_text(provider, e):
+    if isinstance(e, AIQueueFull): return "Şu an herkes aynı anda benimle konuşmaya çalışıyor, biraz sonra tekrar dene. 🥵"
+    if isinstance(e, httpx.HTTPStatusError):
+        logger.error(f"AI API'den HTTP hatası ({provider}): {e.response.status_code} - {e.response.text}")
         return f"API sunucusundan bir hata geldi ({e.response.status_code}). Model adı veya API anahtarında sorun olabilir."
-    except Exception as e: 
-        logger.error(f"AI API genel hatası ({current_model}): {e}", exc_info=True)
-        return "Beynimde bir kısa devre oldu galiba, sonra tekrar dene."
+    logger.error(f"AI API genel hatası ({provider}): {e}", exc_info=True)
+    return "Beynimde bir kısa devre oldu galiba, sonra tekrar dene."
+
+class AIStreamInterrupted(Exception):
+    """Akış ilk parçadan sonra koptu; o ana kadar gelen metin eksik."""
+
+async def _ai_response_stream(prompts, provider):
+    sent = False; t0 = perf_counter()
+    try:
+        logger.info(f"AI akış isteği gönderiliyor. Aktif Model: {provider.upper()}")
+        async for delta in _stream_chat(provider, prompts):
+            if not sent: metrics.observe("ai_first_token_seconds", perf_counter() - t0, provider=provider)
+            sent = True; yield delta
+    except Exception as e:
+        text = _ai_error_text(provider, e)
+        if not sent: yield text
+        else: raise AIStreamInterrupted(text) from e
+    finally: metrics.observe("ai_request_seconds", perf_counter() - t0, provider=provider)
+async def _ai_response(prompts, provider):
+    try:
+        logger.info(f"AI isteği gönderiliyor. Aktif Model: {provider.upper()}")
+        return await _chat(provider, prompts)
+    except Exception as e: return _ai_error_text(provider, e)
+
+async def get_ai_response(prompts, uid=0):
+    """Zamanlayıcıdan slot alıp cevabı döndürür. uid=0 arka plan işleri içindir."""
+    provider = active_provider()
+    try:
+        async with ai_scheduler.slot(uid, provider): return await _ai_response(prompts, provider)
+    except AIQueueFull as e: return _ai_error_text(provider, e)
+
+# --- HAZIR CEVAP HAVUZU ---
+class PromptPool:
+    """Sabit istem şablonları için önbellek: istem hash'ine göre anahtarlı, TTL'li, LRU tahliyeli, kullanıcıya tekrar göstermeyen cevap havuzu.
+    Hedef, henüz kimseye gösterilmemiş (taze) cevap sayısıdır ve talepten öğrenilir: ıska (kullanıcı canlı üretimi bekledi) hedefi büyütür,
+    kimse görmeden bayatlayan cevap küçültür. Taze cevap gösterildikçe yerine yenisi üretilir; trafik yoksa ücretli çağrı yapılmaz.
+    Zamanlanmış şablonlar (günaydın, günün atarı) talebe göre değil, gönderimden önce prefetch_scheduled_prompts ile doldurulur."""
+    def __init__(self, size, ttl, max_templates, seen_per_user, max_users):
+        self.size = size; self.ttl = ttl; self.max_templates = max_templates; self.seen_per_user = seen_per_user; self.max_users = max_users
+        # key -> {"prompts", "items": OrderedDict[item_id -> [created, text, uses]], "seen": OrderedDict[uid -> deque[item_id]], "max", "wanted", "scheduled"}
+        self.entries = OrderedDict()
+        self.hits = 0; self.misses = 0; self.generated = 0; self._next_id = 0
+
+    @staticmethod
+    def key(prompts): return hashlib.sha1(json.dumps(prompts, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+    def register(self, prompts, size=None, scheduled=False):
+        k = self.key(prompts); entry = self.entries.get(k)
+        if entry is None:
+            entry = self.entries[k] = {"prompts": prompts, "items": OrderedDict(), "seen": OrderedDict(), "max": size or self.size, "wanted": 0, "scheduled": scheduled}
+            while len(self.entries) > self.max_templates: self.entries.popitem(last=False)
+        elif size: entry["max"] = size; entry["scheduled"] = scheduled
+        self.entries.move_to_end(k); return entry
+
+    def _expire(self, entry, now):
+        while entry["items"]:
+            item_id, (created, _, uses) = next(iter(entry["items"].items()))
+            if now - created < self.ttl: break
+            del entry["items"][item_id]
+            if not uses: entry["wanted"] = max(0, entry["wanted"] - 1)
+
+    def _mark_seen(self, entry, uid, item_id):
+        seen = entry["seen"].get(uid)
+        if seen is None:
+            seen = entry["seen"][uid] = deque(maxlen=self.seen_per_user)
+            while len(entry["seen"]) > self.max_users: entry["seen"].popitem(last=False)
+        entry["seen"].move_to_end(uid); seen.append(item_id)
+
+    def take(self, prompts, uid):
+        """Kullanıcının daha önce görmediği bir hazır cevap döndürür, yoksa None."""
+        entry = self.register(prompts); self._expire(entry, _monotonic())
+        seen = entry["seen"].get(uid, ())
+        for item_id, item in entry["items"].items():
+            if item_id not in seen:
+                self._mark_seen(entry, uid, item_id); item[2] += 1; self.hits += 1; return item[1]
+        if not entry["scheduled"]: entry["wanted"] = min(entry["max"], entry["wanted"] + 1)
+        self.misses += 1; return None
+
+    def add(self, prompts, text, seen_by=None):
+        """seen_by: canlı üretilip kullanıcıya gösterilen cevap; None ise arka planda üretilmiş taze cevap."""
+        entry = self.register(prompts); self._next_id += 1; self.generated += 1; items = entry["items"]
+        items[self._next_id] = [_monotonic(), text, 0 if seen_by is None else 1]
+        while len(items) > entry["max"]:
+            # Önce gösterilmiş en eski cevap atılır, taze cevaplar korunur
+            del items[next((i for i, item in items.items() if item[2]), next(iter(items)))]
+        if seen_by is not None: self._mark_seen(entry, seen_by, self._next_id)
+
+    @staticmethod
+    def _fresh(entry): return sum(1 for item in entry["items"].values() if not item[2])
+
+    def fresh(self, prompts):
+        entry = self.entries.get(self.key(prompts))
+        if entry is None: return 0
+        self._expire(entry, _monotonic()); return self._fresh(entry)
+
+    def deficit(self, prompts):
+        """Hedefe ulaşmak için üretilmesi gereken taze cevap sayısı (zamanlanmış şablonlarda her zaman 0)."""
+        entry = self.entries.get(self.key(prompts))
+        if entry is None or entry["scheduled"]: return 0
+        self._expire(entry, _monotonic()); return entry["wanted"] - self._fresh(entry)
+
+    def needs_refill(self): return [e["prompts"] for e in list(self.entries.values()) if self.deficit(e["prompts"]) > 0]
+
+    def stats(self):
+        entries = self.entries.values()
+        return {"templates": len(self.entries), "items": sum(len(e["items"]) for e in entries), "fresh": sum(self._fresh(e) for e in entries),
+                "wanted": sum(e["wanted"] for e in entries), "hits": self.hits, "misses": self.misses, "generated": self.generated}
+
+def _monotonic(): return asyncio.get_running_loop().time()
+prompt_pool = PromptPool(PROMPT_POOL_SIZE, PROMPT_POOL_TTL, PROMPT_POOL_MAX_TEMPLATES, PROMPT_POOL_SEEN_PER_USER, PROMPT_POOL_MAX_USERS)
+
+def _prompt(system, user): return [{"role": "system", "content": system}, {"role": "user", "content": user}]
+FAL_PROMPTS = _prompt("Sen gizemli ve alaycı bir falcısın. Kullanıcının geleceği hakkında hem doğru gibi görünen hem de onunla dalga geçen kısa bir yorum yap. Tarot kartları, yıldızlar gibi metaforlar kullan.", "Bana bir fal bak.")
+SAKA_PROMPTS = _prompt("Sen laf sokan, kara mizahı seven bir komedyensin. Kullanıcıyı güldürecek ama aynı zamanda 'buna gülsem mi ağlasam mı' dedirtecek bir şaka yap.", "Bana bir şaka yap.")
+MORNING_PROMPTS = [_prompt("Sen komik ve insanlarla uğraşmayı seven bir asistansın.", p) for p in ["Gruptakileri uyandırmak için komik bir 'günaydın' mesajı yaz.", "Gruba 'Hadi uyanın, daha faturaları ödeyeceğiz!' temalı, esprili bir günaydın mesajı yaz."]]
+RANT_PROMPTS = _prompt("Sen hayatla dalga geçen, bilge bir sokak filozofusun.", "Günün atarını veya lafını içeren, hem düşündürücü hem de komik, kısa bir tweet tarzı mesaj yaz.")
+# (şablon, en fazla hazır cevap, zamanlanmış mı): günde bir kez kullanılan günaydın / günün atarı için tek cevap yeter
+POOLED_PROMPTS = [(FAL_PROMPTS, PROMPT_POOL_SIZE, False), (SAKA_PROMPTS, PROMPT_POOL_SIZE, False), *((p, 1, True) for p in [*MORNING_PROMPTS, RANT_PROMPTS])]
+
+async def pooled_ai_response(prompts, uid=0):
+    """Havuzda kullanıcının görmediği cevap varsa anında döner; yoksa canlı üretir ve havuza ekler."""
+    text = prompt_pool.take(prompts, uid)
+    if text is not None: _kick_refill(prompts); return text
+    provider = active_provider()
+    if not AI_PROVIDERS[provider]["key"]: return AI_PROVIDERS[provider]["missing"]
+    try:
+        async with ai_scheduler.slot(uid, provider): text = await _chat(provider, prompts)
+    except Exception as e: return _ai_error_text(provider, e)
+    prompt_pool.add(prompts, text, seen_by=uid); _kick_refill(prompts); return text
+
+async def _generate_into_pool(prompts, reason):
+    provider = active_provider()
+    if not AI_PROVIDERS[provider]["key"]: return False
+    try:
+        async with ai_scheduler.slot(0, provider): text = await _chat(provider, prompts)
+    except Exception as e: logger.warning(f"Hazır cevap üretilemedi ({reason}): {e}"); return False
+    prompt_pool.add(prompts, text); return True
+
+def _ai_busy(): return ai_scheduler.depth() > 0 or ai_scheduler.inflight >= max(1, AI_MAX_INFLIGHT // 2)
+
+_refill_tasks = {}  # şablon anahtarı -> çalışan doldurma görevi
+def _kick_refill(prompts):
+    """Taze cevap hedefin altına düştüyse arka planda hemen yenisini üretir; sonraki basış havuzdan anında cevaplanır."""
+    key = prompt_pool.key(prompts)
+    if key in _refill_tasks or prompt_pool.deficit(prompts) <= 0: return
+    async def run():
+        try:
+            # Kuyrukta bekleyen ya da kapasitenin yarısını aşan trafik varsa gerçek kullanıcılara yer bırak
+            while prompt_pool.deficit(prompts) > 0 and not _ai_busy():
+                if not await _generate_into_pool(prompts, "doldurma"): break
+        finally: _refill_tasks.pop(key, None)
+    _refill_tasks[key] = asyncio.get_running_loop().create_task(run())
+
+async def refill_prompt_pool(context):
+    """Yoğunluk yüzünden ertelenmiş doldurmaları yeniden başlatır (JobQueue ile periyodik çalışır)."""
+    for prompts in prompt_pool.needs_refill(): _kick_refill(prompts)
+
+async def prefetch_scheduled_prompts(context):
+    """Zamanlanmış grup mesajından (günaydın, günün atarı) biraz önce cevabı üretir; gönderim anında AI beklenmez."""
+    choices = context.job.data
+    if not groups or any(prompt_pool.fresh(p) for p in choices): return
+    await _generate_into_pool(random.choice(choices), "zamanlanmış")
+
+def prompt_pool_stats_text():
+    st = prompt_pool.stats(); total = st["hits"] + st["misses"]
+    rate = f"{100 * st['hits'] / total:.0f}%" if total else "-"
+    return f"- Şablon: {st['templates']}, hazır cevap: {st['items']} (taze {st['fresh']}, hedef {st['wanted']})\n- İsabet: {st['hits']}, ıska: {st['misses']} (oran {rate}), üretilen: {st['generated']}"
 
 # --- MENÜ OLUŞTURMA FONKSİYONLARI ---
 def get_main_menu_keyboard(): return InlineKeyboardMarkup([ [InlineKeyboardButton("🕶 Karanlık Moda Geç", callback_data="dark_mode_on"), InlineKeyboardButton("💡 Normal Moda Dön", callback_data="dark_mode_off")], [InlineKeyboardButton("🎮 Eğlence", callback_data="menu_eglence")], [InlineKeyboardButton("🔮 Fal & Tarot", callback_data="menu_fal")], [InlineKeyboardButton("📊 Etkileşim Analizi", callback_data="menu_analiz")], [InlineKeyboardButton("⚙️ Admin Paneli", callback_data="admin_panel_main")] ])
 def get_eglence_menu_keyboard(): return InlineKeyboardMarkup([[InlineKeyboardButton("😂 Şaka İste", callback_data="ai_saka")], [InlineKeyboardButton("◀️ Ana Menüye Dön", callback_data="menu_main")]])
-def get_admin_menu_keyboard(): return InlineKeyboardMarkup([ [InlineKeyboardButton("📊 İstatistikler", callback_data="admin_stats")], [InlineKeyboardButton("📢 Grupları Yönet", callback_data="admin_list_groups")], [InlineKeyboardButton("📣 Herkese Duyuru", callback_data="admin_broadcast_ask")], [InlineKeyboardButton(f"🧠 AI Model ({current_model.upper()})", callback_data="admin_select_ai")], [InlineKeyboardButton("💾 Verileri Kaydet", callback_data="admin_save")], [InlineKeyboardButton("◀️ Ana Menüye Dön", callback_data="menu_main")] ])
+def get_admin_menu_keyboard(): return InlineKeyboardMarkup([ [InlineKeyboardButton("📊 İstatistikler", callback_data="admin_stats"), InlineKeyboardButton(f"🔬 Profilci ({'AÇIK' if profiler.running else 'KAPALI'})", callback_data="admin_profiler")], [InlineKeyboardButton("📢 Grupları Yönet", callback_data="admin_list_groups")], [InlineKeyboardButton("📣 Herkese Duyuru", callback_data="admin_broadcast_ask")], [InlineKeyboardButton(f"🧠 AI Model ({current_model.upper()})", callback_data="admin_select_ai")], [InlineKeyboardButton("💾 Verileri Kaydet", callback_data="admin_save")], [InlineKeyboardButton("◀️ Ana Menüye Dön", callback_data="menu_main")] ])
+def get_analiz_menu_keyboard(): return InlineKeyboardMarkup([[InlineKeyboardButton("🏆 Bugün", callback_data="analiz_top_d"), InlineKeyboardButton("🏆 Bu Hafta", callback_data="analiz_top_w"), InlineKeyboardButton("🏆 Tüm Zamanlar", callback_data="analiz_top_a")], [InlineKeyboardButton("◀️ Ana Menüye Dön", callback_data="menu_main")]])
 def get_ai_model_menu_keyboard(): return InlineKeyboardMarkup([[InlineKeyboardButton("Google (OpenRouter)", callback_data="ai_model_openrouter")], [InlineKeyboardButton("Venice AI (GPT-4)", callback_data="ai_model_venice")], [InlineKeyboardButton("◀️ Geri", callback_data="admin_panel_main")]])
 
 GET_GROUP_MSG, GET_BROADCAST_MSG, BROADCAST_CONFIRM = range(3)
 
+# --- DUYURU MOTORU ---
+class TokenBucket:
+    """Saniyede `rate` jeton üreten kova; RetryAfter gelince tüm gönderimler `pause` ile durdurulur."""
+    def __init__(self, rate, burst):
+        self.rate = rate; self.burst = burst; self.tokens = burst; self.updated = None; self.paused_until = 0.0
+
+    def pause(self, seconds): self.paused_until = max(self.paused_until, asyncio.get_running_loop().time() + seconds)
+
+    async def acquire(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            now = loop.time()
+            if now < self.paused_until: await asyncio.sleep(self.paused_until - now); continue
+            if self.updated is not None: self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1: self.tokens -= 1; return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class BroadcastEngine:
+    """Hız sınırlarına uyan, eşzamanlı, kaldığı yerden devam edebilen toplu gönderim."""
+    def __init__(self, rate, workers):
+        self.bucket = TokenBucket(rate, burst=max(1.0, rate / 5)); self.workers = workers
+        self.chat_next = {}  # chat_id -> aynı sohbete bir sonraki gönderim anı (zamanı geçenler periyodik silinir)
+        self.running = set()
+
+    async def _wait_chat(self, chat_id, kind):
+        loop = asyncio.get_running_loop(); now = loop.time(); at = max(now, self.chat_next.get(chat_id, 0))
+        self.chat_next[chat_id] = at + (BROADCAST_GROUP_INTERVAL if kind == "groups" else BROADCAST_PRIVATE_INTERVAL)
+        if at > now: await asyncio.sleep(at - now)
+
+    async def _send_one(self, bot, chat_id, text, kind):
+        """Sonuç: 'sent', 'failed' veya 'pruned' (botu engelleyen/silinen sohbet)."""
+        network_retries = 0
+        while True:
+            await self._wait_chat(chat_id, kind); await self.bucket.acquire()
+            try: await bot.send_message(chat_id, text); return "sent"
+            except RetryAfter as e:
+                logger.warning(f"Duyuru flood sınırı: {_retry_seconds(e)} sn bekleniyor."); self.bucket.pause(_retry_seconds(e))
+            except Forbidden: return "pruned"
+            except BadRequest as e:
+                if "chat not found" in str(e).lower() or "chat_id is empty" in str(e).lower(): return "pruned"
+                logger.warning(f"Duyuru gönderilemedi ({chat_id}): {e}"); return "failed"
+            except NetworkError as e:
+                network_retries += 1
+                if network_retries > 2: logger.warning(f"Duyuru gönderilemedi ({chat_id}): {e}"); return "failed"
+                await asyncio.sleep(network_retries)
+            except TelegramError as e: logger.warning(f"Duyuru gönderilemedi ({chat_id}): {e}"); return "failed"
+
+    async def run(self, bot, bid):
+        if bid in self.running: return
+        self.running.add(bid)
+        try: await self._run(bot, bid)
+        finally: self.running.discard(bid)
+
+    async def _run(self, bot, bid):
+        kind, text, admin_chat, status_msg, sent, failed, pruned = store.load_broadcast(bid)
+        await flush_data()
+        done = store.broadcast_done_ids(bid)  # okuyucu bağlantı olay döngüsüne ait; thread'den kullanılmaz
+        targets = [cid for cid in (store.user_ids() if kind == "users" else list(groups)) if cid not in done]
+        logger.info(f"Duyuru #{bid} ({kind}) başlıyor: {len(targets)} hedef, {len(done)} daha önce tamamlanmış.")
+        queue = asyncio.Queue()
+        for cid in targets: queue.put_nowait(cid)
+        st = {"sent": sent, "failed": failed, "pruned": pruned, "done": [], "prune_ids": []}
+        loop = asyncio.get_running_loop(); started = loop.time(); total = len(targets); base = sent + failed + pruned
+
+        async def worker():
+            while True:
+                try: cid = queue.get_nowait()
+                except asyncio.QueueEmpty: return
+                result = await self._send_one(bot, cid, text, kind)
+                st[result] += 1; st["done"].append(cid)
+                if result == "pruned": st["prune_ids"].append(cid)
+
+        async def checkpoint(status="running"):
+            done_ids, st["done"] = st["done"], []; prune_ids, st["prune_ids"] = st["prune_ids"], []
+            if prune_ids: await prune_chats(prune_ids, kind)
+            await asyncio.to_thread(store.record_broadcast, bid, done_ids, st["sent"], st["failed"], st["pruned"], status)
+
+        stop = asyncio.Event()
+        async def reporter():
+            while True:
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(stop.wait(), BROADCAST_STATUS_INTERVAL); return
+                await checkpoint(); drop_expired(self.chat_next, loop.time())
+                if admin_chat and status_msg:
+                    processed = st["sent"] + st["failed"] + st["pruned"] - base; elapsed = loop.time() - started
+                    rate = processed / elapsed if elapsed > 0 else 0; eta = (total - processed) / rate if rate > 0 else 0
+                    text_ = f"🚀 Duyuru #{bid} gönderiliyor...\n{processed}/{total}\n✅ {st['sent']}  ❌ {st['failed']}  🧹 {st['pruned']}\n⚡ {rate:.1f} mesaj/sn, kalan ~{int(eta // 60)} dk {int(eta % 60)} sn"
+                    try: await bot.edit_message_text(text_, chat_id=admin_chat, message_id=status_msg)
+                    except TelegramError: pass
+
+        tasks = [asyncio.create_task(worker()) for _ in range(max(1, min(self.workers, total)))]
+        rep = asyncio.create_task(reporter())
+        try: await asyncio.gather(*tasks)
+        finally:
+            # Bir işçi beklenmedik hatayla düşerse (ya da duyuru iptal edilirse) diğerleri sahipsiz göndermeye devam etmesin
+            for t in tasks: t.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            stop.set(); await rep
+            # Son gönderimlerin aralığı dolunca kalan kayıtlar da silinir
+            loop.call_later(max(BROADCAST_PRIVATE_INTERVAL, BROADCAST_GROUP_INTERVAL), lambda: drop_expired(self.chat_next, loop.time()))
+        await checkpoint(status="done")
+        elapsed = loop.time() - started
+        logger.info(f"Duyuru #{bid} tamamlandı: {st['sent']} başarılı, {st['failed']} hatalı, {st['pruned']} temizlendi ({elapsed:.0f} sn).")
+        if admin_chat:
+            await bot.send_message(admin_chat, f"✅ Duyuru tamamlandı.\nBaşarılı: {st['sent']}\nHatalı: {st['failed']}\nEngelleyen/silinen (temizlendi): {st['pruned']}\nSüre: {elapsed:.0f} sn", reply_markup=get_admin_menu_keyboard())
+
+broadcast_engine = BroadcastEngine(BROADCAST_RATE, BROADCAST_WORKERS)
+
+async def prune_chats(chat_ids, kind):
+    """Botu engelleyen kullanıcıları / botun atıldığı veya silinen grupları kayıtlardan siler."""
+    for cid in chat_ids:
+        if kind == "users": users.pop(cid, None); user_message_counts.pop(cid, None); user_words.pop(cid, None); dirty_users.discard(cid)
+        else: groups.pop(cid, None); dirty_groups.discard(cid)
+    await asyncio.to_thread(store.delete_chats, chat_ids if kind == "users" else (), chat_ids if kind == "groups" else ())
+    logger.info(f"{len(chat_ids)} ulaşılamayan sohbet temizlendi ({kind}).")
+
+async def start_broadcast(app, kind, text, admin_chat=None, status_msg=None):
+    bid = await asyncio.to_thread(store.create_broadcast, kind, text, admin_chat, status_msg)
+    app.create_task(broadcast_engine.run(app.bot, bid), name=f"duyuru_{bid}"); return bid
+
+async def resume_broadcasts(app):
+    for bid in store.running_broadcasts(): logger.info(f"Yarım kalan duyuru #{bid} devam ettiriliyor."); app.create_task(broadcast_engine.run(app.bot, bid), name=f"duyuru_{bid}")
+
 # --- ANA KOMUTLAR ---
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user; get_or_create_user(user.id, user.first_name)
@@ -135,31 +1151,93 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def show_menu(update, text, keyboard): await update.callback_query.edit_message_text(imzali(text), reply_markup=keyboard, parse_mode=ParseMode.HTML)
 async def show_eglence_menu(update, context): await show_menu(update, "Canın sıkıldı demek... Bakalım seni ne kadar güldürebileceğim.", get_eglence_menu_keyboard())
 async def show_analiz_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    uid = update.effective_user.id; count = user_message_counts.get(uid, 0)
-    words = user_words.get(uid, {})
-    top_words = Counter(words).most_common(5)
+    uid = update.effective_user.id; get_or_create_user(uid, update.effective_user.first_name); count = user_message_counts.get(uid, 0)
+    top_words = user_words[uid].top(5)
     top_words_text = "\n".join([f"  - `{word}` ({count} kez)" for word, count in top_words]) if top_words else "Henüz yeterince veri yok."
     text = f"📊 Seninle tam **{count}** defa muhatap olmuşum.\n\nEn çok kullandığın kelimeler:\n{top_words_text}\n\nFena değil, takıntılı olmaya başlıyorsun. 😉"
-    await show_menu(update, text, get_main_menu_keyboard())
+    await show_menu(update, text, get_analiz_menu_keyboard())
+LEADERBOARD_TITLES = {"d": "Bugün", "w": "Bu Hafta", "a": "Tüm Zamanlar"}
+async def show_word_leaderboard(update, context):
+    window = update.callback_query.data.split('_')[-1]; chat = update.effective_chat
+    chat_id = chat.id if chat.type != ChatType.PRIVATE else 0
+    board = top_words(chat_id, window)
+    lines = "\n".join(f"{i}. `{word}` ({n} kez)" for i, (word, n) in enumerate(board, 1)) if board else "Henüz yeterince veri yok."
+    where = "bu grupta" if chat_id else "tüm gruplarda"
+    await show_menu(update, f"🏆 <b>{LEADERBOARD_TITLES.get(window, '')}</b> {where} en çok geçen kelimeler:\n{lines}", get_analiz_menu_keyboard())
 async def set_dark_mode(update, context, is_on: bool):
-    uid = update.effective_user.id
-    if is_on: dark_mode_users.add(uid); await show_menu(update, "☠️ <b>Karanlık Mod</b> aktif. Artık filtre yok, maskeler düştü! Ne istediğini söyle bakalım, çekinme.", get_main_menu_keyboard())
-    else: dark_mode_users.discard(uid); await show_menu(update, "💡 Normal moda dönüldü. Yine sıkıcı ve politik doğrucu olacağım. (Şaka şaka... belki. 😏)", get_main_menu_keyboard())
-async def ai_action_handler(update, context, system_prompt: str, user_prompt: str):
+    uid = update.effective_user.id; get_or_create_user(uid, update.effective_user.first_name).dark_mode = is_on; mark_user_dirty(uid)
+    if is_on: await show_menu(update, "☠️ <b>Karanlık Mod</b> aktif. Artık filtre yok, maskeler düştü! Ne istediğini söyle bakalım, çekinme.", get_main_menu_keyboard())
+    else: await show_menu(update, "💡 Normal moda dönüldü. Yine sıkıcı ve politik doğrucu olacağım. (Şaka şaka... belki. 😏)", get_main_menu_keyboard())
+async def ai_action_handler(update, context, prompts):
     await update.callback_query.answer("Zihnimi kurcalıyorum, bekle...")
-    await update.callback_query.message.reply_text(imzali(await get_ai_response([{"role": "system", "content": system_prompt}, {"role": "user", "content": user_prompt}])), parse_mode=ParseMode.HTML)
-async def ai_fal_tarot(update, context): await ai_action_handler(update, context, "Sen gizemli ve alaycı bir falcısın. Kullanıcının geleceği hakkında hem doğru gibi görünen hem de onunla dalga geçen kısa bir yorum yap. Tarot kartları, yıldızlar gibi metaforlar kullan.", "Bana bir fal bak.")
-async def ai_saka_iste(update, context): await ai_action_handler(update, context, "Sen laf sokan, kara mizahı seven bir komedyensin. Kullanıcıyı güldürecek ama aynı zamanda 'buna gülsem mi ağlasam mı' dedirtecek bir şaka yap.", "Bana bir şaka yap.")
+    await update.callback_query.message.reply_text(imzali(await pooled_ai_response(prompts, uid=update.effective_user.id)), parse_mode=ParseMode.HTML)
+async def ai_fal_tarot(update, context): await ai_action_handler(update, context, FAL_PROMPTS)
+async def ai_saka_iste(update, context): await ai_action_handler(update, context, SAKA_PROMPTS)
+
+# --- AKIŞLI CEVAP (CANLI DÜZENLEME) ---
+def _retry_seconds(e: RetryAfter):
+    ra = e.retry_after; return ra.total_seconds() if hasattr(ra, "total_seconds") else float(ra)
+def drop_expired(deadlines, now):
+    """{anahtar: an} sözlüğünden zamanı geçmiş kayıtları siler (hız sınırı tabloları sınırsız büyümesin)."""
+    for key in [k for k, at in deadlines.items() if at <= now]: del deadlines[key]
+chat_next_edit = {}  # chat_id -> bir sonraki düzenlemeye izin verilen an (sohbet başına hız sınırı)
+async def _edit_text(msg, text, final=False, attempt=0):
+    try: await msg.edit_text(text); return True
+    except RetryAfter as e:
+        chat_next_edit[msg.chat_id] = asyncio.get_running_loop().time() + _retry_seconds(e)
+        if not final or attempt >= 2: return False  # flood sürerse son düzenleme de bırakılır, cevap yeni mesajla gider
+        await asyncio.sleep(_retry_seconds(e)); return await _edit_text(msg, text, final, attempt + 1)
+    except BadRequest as e:
+        if "not modified" in str(e).lower(): return True
+        logger.warning(f"Mesaj düzenlenemedi ({msg.chat_id}): {e}"); return False
+    except NetworkError as e:
+        # Geçici ağ hatası (TimedOut dahil): ara düzenleme atlanır, son düzenleme birkaç kez denenir
+        if not final or attempt >= 2: logger.warning(f"Mesaj düzenlenemedi ({msg.chat_id}): {e}"); return False
+        await asyncio.sleep(attempt + 1); return await _edit_text(msg, text, final, attempt + 1)
+async def _send_text(message, text, attempt=0):
+    """Cevabı yeni mesaj olarak gönderir; flood kontrolünde en fazla iki kez bekleyip yeniden dener."""
+    try: await message.reply_text(text); return True
+    except RetryAfter as e:
+        if attempt >= 2: logger.warning(f"Mesaj gönderilemedi ({message.chat_id}): {e}"); return False
+        await asyncio.sleep(_retry_seconds(e)); return await _send_text(message, text, attempt + 1)
+    except TelegramError as e: logger.warning(f"Mesaj gönderilemedi ({message.chat_id}): {e}"); return False
+async def stream_reply(message, chunks):
+    """Yer tutucu mesaj gönderir, AI parçaları geldikçe birleştirip kısıtlı aralıklarla düzenler. (yer tutucu, metin, tamamlandı mı) döner.
+    Son düzenleme finish_stream_reply ile ayrıca yapılır: flood beklemeleri AI slotu tutulurken yaşanmasın."""
+    loop = asyncio.get_running_loop(); chat_id = message.chat_id
+    interval = STREAM_EDIT_INTERVAL if message.chat.type == ChatType.PRIVATE else STREAM_GROUP_EDIT_INTERVAL
+    text = shown = ""; complete = True
+    try: placeholder = await message.reply_text("💭 ...")
+    except RetryAfter as e:
+        # Yer tutucu flood'a takıldı: AI slotu tutulurken beklenmez, cevap sonunda tek mesajla gider
+        placeholder = None; chat_next_edit[chat_id] = loop.time() + _retry_seconds(e)
+    try:
+        async for delta in chunks:
+            text += delta
+            # Aradaki parçalar biriktirilir, sadece son hali gönderilir
+            if placeholder and loop.time() >= chat_next_edit.get(chat_id, 0) and text != shown:
+                chat_next_edit[chat_id] = loop.time() + interval
+                if await _edit_text(placeholder, text[:TELEGRAM_MAX_TEXT - 2] + " ▌"): shown = text
+    except AIStreamInterrupted: complete = False
+    return placeholder, text, complete
+
+async def finish_stream_reply(message, placeholder, text, complete):
+    """Cevabın son halini yazar, 4096 karakteri aşan kısmı ek mesajlarla gönderir."""
+    final = imzali((text or "...") + ("" if complete else "\n\n⚠️ (Bağlantı koptu, cevap yarıda kesildi.)"))
+    if not (placeholder and await _edit_text(placeholder, final[:TELEGRAM_MAX_TEXT], final=True)):
+        # Yer tutucu yok ya da düzenlenemedi: cevap kaybolmasın, yeni mesaj olarak gönderilir
+        await _send_text(message, final[:TELEGRAM_MAX_TEXT])
+    for i in range(TELEGRAM_MAX_TEXT, len(final), TELEGRAM_MAX_TEXT): await _send_text(message, final[i:i + TELEGRAM_MAX_TEXT])
+    if len(chat_next_edit) > 256: drop_expired(chat_next_edit, asyncio.get_running_loop().time())
 
 # --- METİN İŞLEYİCİ (HAFIZALI) ---
+pending_user_messages = {}  # (uid, chat_id) -> AI slotu bekleyen (henüz cevaplanmamış) mesajlar
 async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id; user_message = update.message.text
     get_or_create_user(uid, update.effective_user.first_name)
     user_message_counts[uid] = user_message_counts.get(uid, 0) + 1
-    words = user_message.lower().split()
-    if uid not in user_words: user_words[uid] = {}
-    for word in words:
-        if len(word) > 3: user_words[uid][word] = user_words[uid].get(word, 0) + 1
+    record_words(uid, update.effective_chat.id if update.effective_chat.type != ChatType.PRIVATE else 0, user_message)
+    mark_user_dirty(uid)
     
     base_prompt = """
 # GÖREVİN & KİMLİĞİN
@@ -176,24 +1254,36 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
 - **Konuşma Stilin:** Politik doğruculuk sana göre değil. Lafını esirgemezsin. Argo ve küfür kullanabilirsin.
 - **Kırmızı Çizgin:** Belirli gruplara (ırk, din vb.) yönelik nefret söylemi ASLA olmaz.
 """
-    system_prompt = base_prompt + (dark_mode_prompt_extension if uid in dark_mode_users else "")
+    system_prompt = base_prompt + (dark_mode_prompt_extension if users[uid].dark_mode else "")
 
-    # Sohbet geçmişini hazırla
-    if uid not in conversation_history: conversation_history[uid] = deque(maxlen=4)
-    
-    # AI'a gönderilecek mesaj listesini oluştur
-    prompts = [{"role": "system", "content": system_prompt}]
-    prompts.extend(list(conversation_history[uid])) # Geçmiş mesajları ekle
-    prompts.append({"role": "user", "content": user_message}) # Yeni mesajı ekle
+    # Slot beklerken gelen mesajlar öncekine eklenir, hepsi tek AI çağrısında cevaplanır
+    key = (uid, update.effective_chat.id)
+    if key in pending_user_messages: pending_user_messages[key].append(update.message); return
+    batch = pending_user_messages[key] = [update.message]
+    provider = active_provider()
+    if not AI_STREAMING:
+        with contextlib.suppress(TelegramError): await context.bot.send_chat_action(update.effective_chat.id, 'typing')
+    try:
+        async with ai_scheduler.slot(uid, provider):
+            del pending_user_messages[key]; user_message = "\n".join(m.text for m in batch); reply_to = batch[-1]
 
-    await context.bot.send_chat_action(update.effective_chat.id, 'typing')
-    response = await get_ai_response(prompts)
-    
-    # Geçmişi güncelle
-    conversation_history[uid].append({"role": "user", "content": user_message})
-    conversation_history[uid].append({"role": "assistant", "content": response})
-    
-    await update.message.reply_text(imzali(response))
+            # AI'a gönderilecek mesaj listesini oluştur: sistem istemi (+ eski konuşmanın özeti), son mesajlar, yeni mesaj
+            prompts = conversation_memory.prompts(uid, system_prompt)
+            prompts.append({"role": "user", "content": user_message})
+
+            complete = True
+            if AI_STREAMING: placeholder, response, complete = await stream_reply(reply_to, _ai_response_stream(prompts, provider))
+            else: response = await _ai_response(prompts, provider)
+    except AIQueueFull as e: await batch[-1].reply_text(imzali(_ai_error_text(provider, e))); return
+    finally:
+        if pending_user_messages.get(key) is batch: del pending_user_messages[key]
+
+    # Geçmişi güncelle (yarıda kesilen cevap kaydedilmez); bütçeden taşan eski mesajlar arka planda özete katılır
+    if complete and conversation_memory.append(uid, user_message, response): context.application.create_task(conversation_memory.summarize(uid))
+
+    # AI slotu bırakıldı: son düzenleme, flood beklemeleri ve ek mesajlar diğer kullanıcıların AI kapasitesini tutmaz
+    if AI_STREAMING: await finish_stream_reply(reply_to, placeholder, response, complete)
+    else: await _send_text(reply_to, imzali(response))
 
 # --- ADMIN PANELİ VE DİĞER FONKSİYONLAR ---
 async def admin_panel(update, context):
@@ -208,10 +1298,24 @@ async def admin_panel(update, context):
 async def show_ai_model_menu(update, context): await show_menu(update, f"Aktif AI: <b>{current_model.upper()}</b>\nYeni modeli seç:", get_ai_model_menu_keyboard())
 async def set_ai_model(update, context):
     global current_model; current_model = update.callback_query.data.split('_')[-1]
+    if WORKER_ID is not None: await asyncio.to_thread(store.write, meta_rows=[("ai_model", current_model)])  # diğer işçiler sync_shared_settings ile alır
     logger.info(f"AI modeli değiştirildi: {current_model.upper()}"); await update.callback_query.answer(f"✅ AI modeli {current_model.upper()} olarak ayarlandı!", show_alert=True); await admin_panel(update, context)
 async def admin_stats(update, context):
-    total_messages = sum(user_message_counts.values())
-    await show_menu(update, f"📊 İstatistikler:\n- Toplam Kullanıcı: {len(users)}\n- Tanınan Grup: {len(groups)}\n- Toplam Mesaj: {total_messages}", get_admin_menu_keyboard())
+    await flush_data(); total_users, total_messages = store.user_totals()
+    await show_menu(update, f"📊 İstatistikler:\n- Toplam Kullanıcı: {total_users} (bellekte {len(users)})\n- Tanınan Grup: {len(groups)}\n- Toplam Mesaj: {total_messages}\n- Disk yazımı: {store.flushes} toplu kayıt, {store.rows_written} satır\n- Sohbet hafızası: {conversation_memory_stats_text()}\n\n🚦 AI Kuyruğu:\n{ai_scheduler_stats_text()}\n\n⚡ Hazır Cevap Havuzu:\n{prompt_pool_stats_text()}\n\n🌐 AI Bağlantı Havuzu:\n{ai_pool_stats_text()}", get_admin_menu_keyboard())
+    await admin_perf(update, context)
+async def admin_perf(update, context):
+    text = (f"⏱ Performans (son örnekler):\n<b>Handler</b>\n{metrics.summary({'handler_seconds'})}\n<b>AI (kuyruk / istek / ilk token)</b>\n{metrics.summary({'ai_queue_wait_seconds', 'ai_request_seconds', 'ai_first_token_seconds'})}"
+            f"\n<b>Olay döngüsü gecikmesi / kayıt</b>\n{metrics.summary({'event_loop_lag_seconds', 'store_loop_blocked_seconds', 'store_write_seconds'})}")
+    await update.callback_query.message.reply_text(text, parse_mode=ParseMode.HTML)
+async def admin_profiler(update, context):
+    if update.effective_user.id != ADMIN_ID: await update.callback_query.answer("🚫 Burası sana yasak bölge.", show_alert=True); return
+    if not profiler.running: profiler.start(); await update.callback_query.answer("🔬 Profilci açıldı. Durdurmak için tekrar bas.", show_alert=True)
+    else:
+        path, top = await asyncio.to_thread(profiler.stop)
+        lines = "\n".join(f"{n} örnek - {frame}" for frame, n in top) or "Örnek yok."
+        await update.callback_query.message.reply_text(f"🔬 Profil: {os.path.basename(path)}\n{lines}")
+    await admin_panel(update, context)
 async def admin_list_groups(update, context):
     if not groups: await update.callback_query.answer("Bot henüz bir gruba eklenmemiş.", show_alert=True); return
     keyboard = [[InlineKeyboardButton(g['title'], callback_data=f"grp_msg_{gid}")] for gid, g in groups.items()]; keyboard.append([InlineKeyboardButton("◀️ Geri", callback_data="admin_panel_main")]); await show_menu(update, "Mesaj göndermek için bir grup seç:", InlineKeyboardMarkup(keyboard))
@@ -223,69 +1327,254 @@ async def send_group_message(update, context):
     except Exception as e: await update.message.reply_text(f"❌ Hata: {e}")
     await admin_panel(update, context); return ConversationHandler.END
 async def ask_broadcast_message(update, context): await show_menu(update, "📣 Tüm kullanıcılara göndermek istediğiniz duyuru mesajını yazın.", None); return GET_BROADCAST_MSG
-async def confirm_broadcast(update, context): context.user_data['broadcast_message'] = update.message.text; await update.message.reply_text(f"DİKKAT! Bu mesaj {len(users)} kullanıcıya gönderilecek. Emin misin?\n\n---\n{update.message.text}\n---", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("✅ EVET, GÖNDER", callback_data="broadcast_send_confirm")], [InlineKeyboardButton("❌ HAYIR, İPTAL", callback_data="admin_panel_main")]])); return BROADCAST_CONFIRM
+async def confirm_broadcast(update, context): context.user_data['broadcast_message'] = update.message.text; await flush_data(); await update.message.reply_text(f"DİKKAT! Bu mesaj {store.user_totals()[0]} kullanıcıya gönderilecek. Emin misin?\n\n---\n{update.message.text}\n---", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("✅ EVET, GÖNDER", callback_data="broadcast_send_confirm")], [InlineKeyboardButton("❌ HAYIR, İPTAL", callback_data="admin_panel_main")]])); return BROADCAST_CONFIRM
 async def do_broadcast(update, context):
-    msg = context.user_data.pop('broadcast_message', None); await update.callback_query.edit_message_text("🚀 Duyuru gönderimi başladı...", reply_markup=None); s, f = 0, 0
-    for uid in list(users.keys()):
-        try: await context.bot.send_message(uid, msg); s += 1; await asyncio.sleep(0.1)
-        except Exception: f += 1
-    await update.callback_query.message.reply_text(f"✅ Duyuru tamamlandı.\nBaşarılı: {s}\nHatalı: {f}"); await admin_panel(update, context); return ConversationHandler.END
+    msg = context.user_data.pop('broadcast_message', None); status = await update.callback_query.edit_message_text("🚀 Duyuru gönderimi başladı...", reply_markup=None)
+    await start_broadcast(context.application, "users", msg, admin_chat=status.chat_id, status_msg=status.message_id)
+    return ConversationHandler.END
+async def admin_save(update, context):
+    await flush_data(); await update.callback_query.answer("💾 Veriler kaydedildi.", show_alert=True)
 async def cancel_conversation(update, context): context.user_data.clear(); await update.message.reply_text("İşlem iptal edildi."); await admin_panel(update, context); return ConversationHandler.END
 async def record_group_chat(update, context):
     cid, title = update.effective_chat.id, update.effective_chat.title
-    if cid not in groups or groups[cid]['title'] != title: groups[cid] = {'title': title}; save_all_data(); logger.info(f"Grup tanındı/güncellendi: {title} ({cid})")
+    if cid not in groups or groups[cid]['title'] != title: groups[cid] = {'title': title}; mark_group_dirty(cid); logger.info(f"Grup tanındı/güncellendi: {title} ({cid})")
 async def send_morning_message(context):
     if not groups: return
-    prompt = random.choice(["Gruptakileri uyandırmak için komik bir 'günaydın' mesajı yaz.", "Gruba 'Hadi uyanın, daha faturaları ödeyeceğiz!' temalı, esprili bir günaydın mesajı yaz."])
-    message = await get_ai_response([{"role": "system", "content": "Sen komik ve insanlarla uğraşmayı seven bir asistansın."}, {"role": "user", "content": prompt}])
-    for gid in groups:
-        try: await context.bot.send_message(gid, imzali(f"☀️ GÜNAYDIN EKİP! ☀️\n\n{message}")); await asyncio.sleep(1)
-        except Exception as e: logger.error(f"Gruba ({gid}) günaydın mesajı gönderilemedi: {e}")
+    prompts = next((p for p in MORNING_PROMPTS if prompt_pool.fresh(p)), None) or random.choice(MORNING_PROMPTS)  # önceden hazırlanan şablon
+    message = await pooled_ai_response(prompts)
+    await start_broadcast(context.application, "groups", imzali(f"☀️ GÜNAYDIN EKİP! ☀️\n\n{message}"))
 async def send_daily_rant(context):
     if not groups: return
-    prompt = "Günün atarını veya lafını içeren, hem düşündürücü hem de komik, kısa bir tweet tarzı mesaj yaz."
-    message = await get_ai_response([{"role": "system", "content": "Sen hayatla dalga geçen, bilge bir sokak filozofusun."}, {"role": "user", "content": prompt}])
-    for gid in groups:
-        try: await context.bot.send_message(gid, imzali(f"🔥 GÜNÜN ATARI 🔥\n\n{message}")); await asyncio.sleep(1)
-        except Exception as e: logger.error(f"Gruba ({gid}) günün atarı gönderilemedi: {e}")
+    message = await pooled_ai_response(RANT_PROMPTS)
+    await start_broadcast(context.application, "groups", imzali(f"🔥 GÜNÜN ATARI 🔥\n\n{message}"))
+
+# --- GÜNCELLEME İŞLEME (SOHBET SIRALI, EŞZAMANLI) ---
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Aynı (sohbet, kullanıcı) güncellemelerini geliş sırasıyla, farklı olanları en fazla `concurrency` tanesi eşzamanlı işler.
+    ConversationHandler anahtarı da (sohbet, kullanıcı) olduğu için sihirbaz adımları karışmaz. Temel sınıfın semaforu sadece
+    bekleyen güncelleme sınırıdır; asıl slot sıra gelince alınır, böylece sırasını bekleyen güncelleme başkasının slotunu işgal etmez."""
+    def __init__(self, concurrency, max_pending=UPDATE_MAX_PENDING):
+        super().__init__(max(concurrency, max_pending))
+        self.concurrency = concurrency; self.slots = asyncio.Semaphore(concurrency); self.active = 0
+        self.tails = {}  # anahtar -> zincirdeki son güncellemenin bitiş olayı
+
+    @staticmethod
+    def update_key(update):
+        if not isinstance(update, Update): return None
+        chat, user = update.effective_chat, update.effective_user
+        return None if chat is None and user is None else (chat.id if chat else None, user.id if user else None)
+
+    async def do_process_update(self, update, coroutine):
+        key = self.update_key(update); t0 = perf_counter(); started = False
+        previous = self.tails.get(key) if key else None; done = asyncio.Event()
+        if key: self.tails[key] = done
+        try:
+            if previous is not None: await previous.wait()
+            async with self.slots:
+                metrics.observe("update_wait_seconds", perf_counter() - t0); started = True; self.active += 1
+                try: await coroutine
+                finally: self.active -= 1
+        finally:
+            if not started: coroutine.close()
+            done.set()
+            if key and self.tails.get(key) is done: del self.tails[key]
+
+    async def initialize(self): pass
+    async def shutdown(self): pass
+
+# --- WEBHOOK VE İŞÇİ SÜREÇLER ---
+def is_primary_worker(): return WORKER_ID in (None, 0)  # zamanlanmış duyurular ve yarım kalan duyurular tek süreçte çalışır
+
+def _stop_event():
+    stop = asyncio.Event(); loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        with contextlib.suppress(NotImplementedError): loop.add_signal_handler(sig, stop.set)
+    return stop
+
+def ensure_webhook_secret():
+    """Gizli anahtar yoksa üretir: herkese açık dinleyiciye sahte (örn. admin adına) güncelleme gönderilemesin."""
+    global WEBHOOK_SECRET
+    if not WEBHOOK_SECRET: WEBHOOK_SECRET = secrets.token_urlsafe(32); logger.info("WEBHOOK_SECRET verilmedi, rastgele gizli anahtar üretildi.")
+
+async def set_webhook(bot):
+    await bot.set_webhook(f"{WEBHOOK_URL}/{WEBHOOK_PATH}", secret_token=WEBHOOK_SECRET, allowed_updates=Update.ALL_TYPES, max_connections=WEBHOOK_MAX_CONNECTIONS)
+    logger.info(f"Webhook ayarlandı: {WEBHOOK_URL}/{WEBHOOK_PATH} (dinleniyor: {WEBHOOK_LISTEN}:{WEBHOOK_PORT})")
+
+def webhook_handler(deliver):
+    """Telegram'ın POST ettiği güncellemeyi deliver(sözlük, ham gövde) ile iletir; işlenmesi beklenmeden 200 döner."""
+    path = f"/{WEBHOOK_PATH}"; text = "text/plain; charset=utf-8"
+    async def handler(method, req_path, headers, body):
+        if method != "POST" or req_path.split("?")[0].rstrip("/") != path: return "404 Not Found", b"", text
+        if not WEBHOOK_SECRET or not hmac.compare_digest(headers.get("x-telegram-bot-api-secret-token", "").encode(), WEBHOOK_SECRET.encode()): return "403 Forbidden", b"", text
+        try: data = json.loads(body)
+        except ValueError: data = None
+        if not isinstance(data, dict) or not isinstance(data.get("update_id"), int): return "400 Bad Request", b"", text
+        try: await deliver(data, body)
+        except Exception as e: logger.warning(f"Geçersiz webhook güncellemesi atlandı: {e}"); metrics.inc("webhook_rejected_total"); return "400 Bad Request", b"", text
+        metrics.inc("webhook_updates_total"); return "200 OK", b"", text
+    return handler
+
+async def run_webhook(app):
+    """Tek süreçli webhook modu: dinleyici güncellemeleri doğrudan update_queue'ya koyar."""
+    stop = _stop_event(); ensure_webhook_secret()
+    await app.initialize(); await app.post_init(app); await app.start()
+    async def deliver(data, body): await app.update_queue.put(Update.de_json(data, app.bot))
+    server = await asyncio.start_server(http_server(webhook_handler(deliver)), WEBHOOK_LISTEN, WEBHOOK_PORT)
+    try: await set_webhook(app.bot); await stop.wait()
+    finally:
+        server.close(); await app.stop(); await app.shutdown(); await app.post_shutdown(app)
+
+def shard_of(data, count):
+    """Kullanıcıya (yoksa sohbete) göre işçi seçer. Özel sohbette ikisi aynıdır; gruplarda kullanıcıya göre dağıtmak kullanıcının
+    tüm durumunu (sayaçlar, hafıza, karanlık mod, sihirbazlar) tek işçide tutar."""
+    for value in data.values():
+        if not isinstance(value, dict): continue
+        owner = value.get("from") or value.get("user") or value.get("chat") or (value.get("message") or {}).get("chat") or {}
+        if "id" in owner: return owner["id"] % count
+    return 0
+
+async def _worker_loop(app, updates):
+    stop = _stop_event()
+    await app.initialize(); await app.post_init(app); await app.start()
+    try:
+        while not stop.is_set():
+            try: raw = await asyncio.to_thread(updates.get, True, 0.5)
+            except queue.Empty: continue
+            if raw is None: break
+            # Tek bir bozuk güncelleme işçiyi (ve ön sürecin izlemesiyle tüm botu) düşürmesin
+            try: update = Update.de_json(json.loads(raw), app.bot)
+            except Exception as e: logger.warning(f"Geçersiz güncelleme atlandı: {e}"); continue
+            await app.update_queue.put(update)
+    finally: await app.stop(); await app.shutdown(); await app.post_shutdown(app)
+
+def run_worker(index, updates):
+    """İşçi süreç: ön süreçten gelen ham güncellemeleri kendi Application'ında işler; veriler ortak SQLite deposunda."""
+    global WORKER_ID, METRICS_PORT
+    WORKER_ID = index
+    if METRICS_PORT: METRICS_PORT += 1 + index
+    for handler in logging.getLogger().handlers: handler.setFormatter(logging.Formatter(f"%(asctime)s - w{index} - %(name)s - %(levelname)s - %(message)s"))
+    try: load_data(); asyncio.run(_worker_loop(build_application(updater=None), updates))
+    except Exception as e: logger.critical(f"İşçi {index} hatası: {e}", exc_info=True)
+    finally: save_all_data(); store.close()
+
+async def _front_loop(queues, workers):
+    stop = _stop_event(); ensure_webhook_secret()
+    async def deliver(data, body): queues[shard_of(data, len(queues))].put(body)
+    server = await asyncio.start_server(http_server(webhook_handler(deliver)), WEBHOOK_LISTEN, WEBHOOK_PORT)
+    try:
+        async with Bot(TOKEN) as bot: await set_webhook(bot)
+        while not stop.is_set():
+            with contextlib.suppress(asyncio.TimeoutError): await asyncio.wait_for(stop.wait(), 5)
+            if dead := [w.name for w in workers if not w.is_alive()]: logger.critical(f"İşçi süreç durdu: {', '.join(dead)}; bot kapatılıyor."); break
+    finally: server.close()
+
+def run_sharded():
+    """Ön süreç webhook'u dinler, güncellemeleri WORKERS işçiye dağıtır. AI eşzamanlılık sınırları işçilere bölünür."""
+    store.open(); store.migrate_json(); store.write(meta_rows=[("ai_model", DEFAULT_AI_MODEL)]); store.close()
+    for name, total in (("AI_MAX_INFLIGHT", AI_MAX_INFLIGHT), ("AI_PROVIDER_MAX_INFLIGHT", AI_PROVIDER_MAX_INFLIGHT), ("AI_MAX_CONNECTIONS", AI_MAX_CONNECTIONS), ("AI_MAX_QUEUE", AI_MAX_QUEUE)):
+        os.environ[name] = str(max(1, total // WORKERS))  # işçiler bu değerleri import sırasında okur
+    ctx = multiprocessing.get_context("spawn"); queues = [ctx.Queue() for _ in range(WORKERS)]
+    workers = [ctx.Process(target=run_worker, args=(i, q), name=f"isci-{i}") for i, q in enumerate(queues)]
+    for w in workers: w.start()
+    logger.info(f"{WORKERS} işçi süreç başlatıldı.")
+    try: asyncio.run(_front_loop(queues, workers))
+    finally:
+        for q in queues: q.put(None)
+        for w in workers: w.join(30)
+
+async def sync_shared_settings(context):
+    """Çok işçili modda diğer işçilerin değiştirdiği ayarları ve tanıdığı grupları depodan alır."""
+    global current_model
+    current_model = store.get_meta("ai_model") or current_model
+    for gid, group in store.load_groups().items(): groups.setdefault(gid, group)
 
 # --- BOTU BAŞLATMA ---
-def main():
-    if not TOKEN: logger.critical("TOKEN eksik!"); return
-    load_data()
-    app = Application.builder().token(TOKEN).build()
-    jq = app.job_queue; 
-    turkey_tz = pytz.timezone("Europe/Istanbul")
-    jq.run_daily(send_morning_message, time=time(hour=9, minute=0, tzinfo=turkey_tz), name="gunaydin")
-    jq.run_daily(send_daily_rant, time=time(hour=13, minute=37, tzinfo=turkey_tz), name="gunun_atari")
+background_tasks = []
+def register_gauges():
+    metrics.gauge("ai_queue_depth", ai_scheduler.depth); metrics.gauge("ai_inflight", lambda: ai_scheduler.inflight)
+    metrics.gauge("users_in_memory", lambda: len(users)); metrics.gauge("conversations_in_memory", lambda: len(conversation_memory.hot))
+    metrics.gauge("word_scopes_in_memory", lambda: len(word_scopes)); metrics.gauge("prompt_pool_items", lambda: prompt_pool.stats()["items"])
+    for name, pool in ai_clients.items():
+        for key in ("in_use", "idle"): metrics.gauge(f"ai_pool_{key}", lambda pool=pool, key=key: pool.stats()[key], provider=name)
+
+async def on_startup(app):
+    register_gauges(); background_tasks.append(asyncio.create_task(monitor_loop_lag()))
+    if METRICS_PORT:
+        server = await asyncio.start_server(http_server(_metrics_handler), METRICS_HOST, METRICS_PORT); background_tasks.append(server)
+        logger.info(f"Metrikler http://{METRICS_HOST}:{METRICS_PORT}/metrics adresinde.")
+    if isinstance(app.update_processor, ChatOrderedUpdateProcessor):
+        metrics.gauge("updates_pending", lambda: app.update_processor.current_concurrent_updates); metrics.gauge("updates_active", lambda: app.update_processor.active)
+    if PROFILER_ON_START: profiler.start()
+    for pool in ai_clients.values(): pool.start()
+    for prompts, size, scheduled in POOLED_PROMPTS: prompt_pool.register(prompts, size, scheduled)
+    if is_primary_worker(): await resume_broadcasts(app)
+async def on_shutdown(app):
+    for task in background_tasks:
+        if isinstance(task, asyncio.Task): task.cancel()
+        else: task.close()
+    if profiler.running: profiler.stop()
+    # Yarım kalan doldurmalar kapanan bağlantı havuzunu kullanmasın
+    refills = list(_refill_tasks.values())
+    for task in refills: task.cancel()
+    await asyncio.gather(*refills, return_exceptions=True)
+    for pool in ai_clients.values(): await pool.close()
+    await flush_data()
+
+def build_application(token=None, **builder_options):
+    """Handler'ları ve zamanlanmış işleri kurulmuş Application döndürür. builder_options: ApplicationBuilder ayarları (örn. base_url)."""
+    builder = Application.builder().token(token or TOKEN).post_init(on_startup).post_shutdown(on_shutdown).concurrent_updates(ChatOrderedUpdateProcessor(UPDATE_CONCURRENCY))
+    for name, value in builder_options.items(): builder = getattr(builder, name)(value)
+    app = builder.build()
+    jq = app.job_queue
+    if is_primary_worker():
+        jq.run_daily(prefetch_scheduled_prompts, time=time(hour=8, minute=50, tzinfo=TURKEY_TZ), data=MORNING_PROMPTS, name="gunaydin_hazirlik")
+        jq.run_daily(send_morning_message, time=time(hour=9, minute=0, tzinfo=TURKEY_TZ), name="gunaydin")
+        jq.run_daily(prefetch_scheduled_prompts, time=time(hour=13, minute=27, tzinfo=TURKEY_TZ), data=[RANT_PROMPTS], name="gunun_atari_hazirlik")
+        jq.run_daily(send_daily_rant, time=time(hour=13, minute=37, tzinfo=TURKEY_TZ), name="gunun_atari")
+    if WORKER_ID is not None: jq.run_repeating(sync_shared_settings, interval=15, first=15, name="ortak_ayarlar")
+    jq.run_daily(prune_word_stats, time=time(hour=4, minute=0, tzinfo=TURKEY_TZ), name="kelime_temizligi")
+    jq.run_repeating(flush_data, interval=STORE_FLUSH_INTERVAL, first=STORE_FLUSH_INTERVAL, name="veri_kaydi")
+    jq.run_repeating(evict_idle_conversations, interval=60, first=60, name="hafiza_tahliyesi")
+    jq.run_repeating(refill_prompt_pool, interval=PROMPT_POOL_REFILL_INTERVAL, first=5, name="hazir_cevap_havuzu")
     
-    group_msg_handler = ConversationHandler(entry_points=[CallbackQueryHandler(ask_group_message, pattern="^grp_msg_")], states={GET_GROUP_MSG: [MessageHandler(filters.TEXT & ~filters.COMMAND, send_group_message)]}, fallbacks=[CommandHandler("iptal", cancel_conversation), CallbackQueryHandler(admin_panel, pattern="^admin_panel_main$")])
-    broadcast_handler = ConversationHandler(entry_points=[CallbackQueryHandler(ask_broadcast_message, pattern="^admin_broadcast_ask$")], states={GET_BROADCAST_MSG: [MessageHandler(filters.TEXT & ~filters.COMMAND, confirm_broadcast)], BROADCAST_CONFIRM: [CallbackQueryHandler(do_broadcast, pattern="^broadcast_send_confirm$")]}, fallbacks=[CommandHandler("iptal", cancel_conversation), CallbackQueryHandler(admin_panel, pattern="^admin_panel_main$")])
+    group_msg_handler = ConversationHandler(entry_points=[CallbackQueryHandler(timed("ask_group_message", ask_group_message), pattern="^grp_msg_")], states={GET_GROUP_MSG: [MessageHandler(filters.TEXT & ~filters.COMMAND, timed("send_group_message", send_group_message))]}, fallbacks=[CommandHandler("iptal", timed("cancel_conversation", cancel_conversation)), CallbackQueryHandler(timed("admin_panel", admin_panel), pattern="^admin_panel_main$")])
+    broadcast_handler = ConversationHandler(entry_points=[CallbackQueryHandler(timed("ask_broadcast_message", ask_broadcast_message), pattern="^admin_broadcast_ask$")], states={GET_BROADCAST_MSG: [MessageHandler(filters.TEXT & ~filters.COMMAND, timed("confirm_broadcast", confirm_broadcast))], BROADCAST_CONFIRM: [CallbackQueryHandler(timed("do_broadcast", do_broadcast), pattern="^broadcast_send_confirm$")]}, fallbacks=[CommandHandler("iptal", timed("cancel_conversation", cancel_conversation)), CallbackQueryHandler(timed("admin_panel", admin_panel), pattern="^admin_panel_main$")])
 
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CommandHandler("admin", admin_panel))
+    app.add_handler(CommandHandler("start", timed("start", start)))
+    app.add_handler(CommandHandler("admin", timed("admin_panel", admin_panel)))
     app.add_handler(group_msg_handler); app.add_handler(broadcast_handler)
-    app.add_handler(CallbackQueryHandler(start, pattern="^menu_main$"))
-    app.add_handler(CallbackQueryHandler(show_eglence_menu, pattern="^menu_eglence$"))
-    app.add_handler(CallbackQueryHandler(ai_fal_tarot, pattern="^menu_fal$"))
-    app.add_handler(CallbackQueryHandler(show_analiz_menu, pattern="^menu_analiz$"))
-    app.add_handler(CallbackQueryHandler(lambda u,c: set_dark_mode(u,c,is_on=True), pattern="^dark_mode_on$"))
-    app.add_handler(CallbackQueryHandler(lambda u,c: set_dark_mode(u,c,is_on=False), pattern="^dark_mode_off$"))
-    app.add_handler(CallbackQueryHandler(ai_saka_iste, pattern="^ai_saka$"))
-    app.add_handler(CallbackQueryHandler(admin_panel, pattern="^admin_panel_main$"))
-    app.add_handler(CallbackQueryHandler(admin_stats, pattern="^admin_stats$"))
-    app.add_handler(CallbackQueryHandler(save_all_data, pattern="^admin_save$"))
-    app.add_handler(CallbackQueryHandler(admin_list_groups, pattern="^admin_list_groups$"))
-    app.add_handler(CallbackQueryHandler(show_ai_model_menu, pattern="^admin_select_ai$"))
-    app.add_handler(CallbackQueryHandler(set_ai_model, pattern="^ai_model_"))
+    app.add_handler(CallbackQueryHandler(timed("start", start), pattern="^menu_main$"))
+    app.add_handler(CallbackQueryHandler(timed("show_eglence_menu", show_eglence_menu), pattern="^menu_eglence$"))
+    app.add_handler(CallbackQueryHandler(timed("ai_fal_tarot", ai_fal_tarot), pattern="^menu_fal$"))
+    app.add_handler(CallbackQueryHandler(timed("show_analiz_menu", show_analiz_menu), pattern="^menu_analiz$"))
+    app.add_handler(CallbackQueryHandler(timed("show_word_leaderboard", show_word_leaderboard), pattern="^analiz_top_[dwa]$"))
+    app.add_handler(CallbackQueryHandler(timed("dark_mode_on", lambda u,c: set_dark_mode(u,c,is_on=True)), pattern="^dark_mode_on$"))
+    app.add_handler(CallbackQueryHandler(timed("dark_mode_off", lambda u,c: set_dark_mode(u,c,is_on=False)), pattern="^dark_mode_off$"))
+    app.add_handler(CallbackQueryHandler(timed("ai_saka_iste", ai_saka_iste), pattern="^ai_saka$"))
+    app.add_handler(CallbackQueryHandler(timed("admin_panel", admin_panel), pattern="^admin_panel_main$"))
+    app.add_handler(CallbackQueryHandler(timed("admin_stats", admin_stats), pattern="^admin_stats$"))
+    app.add_handler(CallbackQueryHandler(timed("admin_save", admin_save), pattern="^admin_save$"))
+    app.add_handler(CallbackQueryHandler(timed("admin_profiler", admin_profiler), pattern="^admin_profiler$"))
+    app.add_handler(CallbackQueryHandler(timed("admin_list_groups", admin_list_groups), pattern="^admin_list_groups$"))
+    app.add_handler(CallbackQueryHandler(timed("show_ai_model_menu", show_ai_model_menu), pattern="^admin_select_ai$"))
+    app.add_handler(CallbackQueryHandler(timed("set_ai_model", set_ai_model), pattern="^ai_model_"))
     
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
-    app.add_handler(MessageHandler(filters.StatusUpdate.NEW_CHAT_MEMBERS, record_group_chat))
+    # block=False: AI cevabı beklenirken aynı sohbetin sıradaki güncellemeleri de işlenir (bekleyen mesajlar birleştirilir), eşzamanlılığı zamanlayıcı sınırlar
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, timed("handle_text", handle_text), block=False))
+    app.add_handler(MessageHandler(filters.StatusUpdate.NEW_CHAT_MEMBERS, timed("record_group_chat", record_group_chat)))
+    return app
 
+def main():
+    if not TOKEN: logger.critical("TOKEN eksik!"); return
+    if WORKERS > 1:
+        if WEBHOOK_URL: run_sharded(); return
+        logger.warning("WORKERS > 1 sadece webhook modunda kullanılabilir (WEBHOOK_URL), tek süreçle devam ediliyor.")
+    load_data()
     logger.info(f"DarkJarvis (v3.0 - Hafıza Entegrasyonu) başarıyla başlatıldı!")
-    app.run_polling()
+    if WEBHOOK_URL: asyncio.run(run_webhook(build_application(updater=None)))
+    else: build_application().run_polling()
 
 if __name__ == '__main__':
     try: main()
     except Exception as e: logger.critical(f"Kritik hata: {e}", exc_info=True)
-    finally: save_all_data(); logger.info("Bot durduruluyor, veriler kaydedildi.")
+    finally: save_all_data(); store.close(); logger.info("Bot durduruluyor, veriler kaydedildi.")